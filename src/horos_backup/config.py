@@ -12,6 +12,8 @@ The defaults mimic the previous monolithic script. A BackupConfig bundles
 filesystem paths and runtime settings, making it easy to reuse with
 alternative roots during testing.
 """
+import logging
+import os
 from dataclasses import dataclass, field
 from pathlib import Path
 from typing import Optional, Tuple
@@ -54,12 +56,36 @@ class Settings:
     incoming_max_files: int = 25_000
     order_by: str = "study_date"  # accepted values: "study_date" | "date_added"
     batch_size: int = 15
-    sleep_between_studies: int = 1  # seconds
+    sleep_between_studies: int = 1  # seconds; pause after a batch while Horos is importing
+    incoming_throttle_files: int = 1_000  # pause only when INCOMING holds more files than this
+    load_throttle_factor: float = 0.8  # brief pause before a study when load1 > cpu_count * factor
+    load_throttle_sleep: float = 0.1  # seconds
+    zip_study_workers: int = 4  # studies zipped concurrently
+    deflate_level: int = 1  # zlib level for studies with native (uncompressed) pixel data
+    # Full testzip() on every ZIP instead of the central-directory check (HOROS_DEEP_VERIFY=1).
+    deep_verify: bool = field(default_factory=lambda: os.environ.get("HOROS_DEEP_VERIFY") == "1")
     mods: Tuple[str, ...] = ("CT", "MR")
     max_name_noext: int = 128
     use_db_copy: bool = True
     log_max_bytes: int = 100 * 1024 * 1024  # 100 MB
     log_backup_count: int = 10
+    # Logger level; DEBUG adds per-study/per-image diagnostics (HOROS_LOG_LEVEL=DEBUG).
+    log_level: str = field(default_factory=lambda: os.environ.get("HOROS_LOG_LEVEL", "INFO"))
+
+    def __post_init__(self):
+        # Check the deflate level once, here, instead of letting every worker
+        # of every native study fail on it: ISA-L only accepts levels 0-3.
+        from .zip_utils import MAX_DEFLATE_LEVEL
+
+        level = int(self.deflate_level)
+        if not 0 <= level <= 9:
+            raise ValueError(f"deflate_level must be between 0 and 9, got {self.deflate_level!r}")
+        if level > MAX_DEFLATE_LEVEL:
+            logging.getLogger("horos_backup").warning(
+                "deflate_level %d is not supported by the active zlib backend; using %d.", level, MAX_DEFLATE_LEVEL
+            )
+            level = MAX_DEFLATE_LEVEL
+        self.deflate_level = level
 
 
 @dataclass
@@ -9,7 +9,9 @@
 """Date-related helpers used across the backup pipeline."""
 from __future__ import annotations
 
+import functools
 import logging
+import math
 import re
 from datetime import datetime, timedelta
 from pathlib import Path
@@ -19,7 +21,14 @@ from .config import BackupConfig
 
 APPLE_EPOCH = datetime(2001, 1, 1)
 
+_DATE_RE1 = re.compile(r"(\d{4})[-/](\d{2})[-/](\d{2})")
+_DATE_RE2 = re.compile(r"(\d{4})[-/](\d{2})")
+# Only strings starting like a number can be CoreData seconds; checking this
+# up front avoids raising ValueError from float() for every textual date.
+_NUMERIC_START = frozenset("0123456789.-+")
 
+
+@functools.lru_cache(maxsize=4096, typed=True)
 def parse_timestamp_to_parts(ts) -> Tuple[Optional[str], Optional[str], Optional[str]]:
     """
     Convert different timestamp shapes to ``(YYYY, MM, DD)`` strings.
@@ -29,30 +38,51 @@ def parse_timestamp_to_parts(ts) -> Tuple[Optional[str], Optional[str], Optional
     - ``YYYYMMDD``.
     - ``YYYY-MM-DD`` or variations with ``/``.
     - Best-effort lookups for ``YYYY-MM``.
+
+    Results are memoized: the same study date and DOB are parsed several
+    times per study (folder, file name, debug output).
     """
     if ts is None:
         return (None, None, None)
 
+    # SQLite hands ZDATE back as a float; skip the str()/float() round trip.
+    if type(ts) in (float, int) and math.isfinite(ts):
+        dt = APPLE_EPOCH + timedelta(seconds=ts)
+        return (f"{dt.year:04d}", f"{dt.month:02d}", f"{dt.day:02d}")
+
     s = str(ts).strip()
     if not s:
         return (None, None, None)
 
-    try:
-        # Horos stores CoreData timestamps as seconds since 2001-01-01.
-        secs = float(s)
-        dt = APPLE_EPOCH + timedelta(seconds=secs)
-        return (f"{dt.year:04d}", f"{dt.month:02d}", f"{dt.day:02d}")
-    except ValueError:
-        pass
+    if s[0] in _NUMERIC_START:
+        try:
+            # Horos stores CoreData timestamps as seconds since 2001-01-01.
+            secs = float(s)
+            dt = APPLE_EPOCH + timedelta(seconds=secs)
+            return (f"{dt.year:04d}", f"{dt.month:02d}", f"{dt.day:02d}")
+        except ValueError:
+            pass
 
     if len(s) == 8 and s.isdigit():
         return (s[0:4], s[4:6], s[6:8])
 
-    m = re.search(r"(\d{4})[-/](\d{2})[-/](\d{2})", s)
+    # Fixed-position YYYY-MM-DD / YYYY/MM/DD prefix: no regex needed
+    # (isdecimal() matches exactly what \d does).
+    if (
+        len(s) >= 10
+        and s[4] in "-/"
+        and s[7] in "-/"
+        and s[:4].isdecimal()
+        and s[5:7].isdecimal()
+        and s[8:10].isdecimal()
+    ):
+        return (s[0:4], s[5:7], s[8:10])
+
+    m = _DATE_RE1.search(s)
     if m:
         return (m.group(1), m.group(2), m.group(3))
 
-    m2 = re.search(r"(\d{4})[-/](\d{2})", s)
+    m2 = _DATE_RE2.search(s)
     if m2:
         return (m2.group(1), m2.group(2), "01")
 
@@ -12,12 +12,19 @@ from __future__ import annotations
 import logging
 import os
 import sqlite3
-from typing import Optional
+from typing import Callable, Optional
 
 from .config import BackupConfig
+from .state import get_snapshot_signature, set_snapshot_signature, state_connect
 
 
-def copy_horos_db_consistent(config: BackupConfig) -> str:
+# Pages copied per sqlite3_backup_step(); large steps mean few lock round-trips.
+SNAPSHOT_BACKUP_PAGES = 1024
+
+
+def copy_horos_db_consistent(
+    config: BackupConfig, progress: Optional[Callable[[int, int, int], object]] = None
+) -> str:
     paths = config.paths
     if not paths.horos_db_orig.exists():
         raise FileNotFoundError(f"Horos DB not found: {paths.horos_db_orig}")
@@ -36,10 +43,18 @@ def copy_horos_db_consistent(config: BackupConfig) -> str:
     except Exception:
         pass
 
-    # Copy to a temp-friendly location inside the backup tree.
+    # Copy to a temp-friendly location inside the backup tree. The snapshot
+    # is disposable (recreated on failure), so it needs no journal or fsync.
     dst = sqlite3.connect(str(paths.dbcopy_path))
     try:
-        src.backup(dst)
+        for pragma in (
+            "PRAGMA journal_mode=OFF;",
+            "PRAGMA synchronous=OFF;",
+            "PRAGMA locking_mode=EXCLUSIVE;",
+            "PRAGMA temp_store=MEMORY;",
+        ):
+            dst.execute(pragma)
+        src.backup(dst, pages=SNAPSHOT_BACKUP_PAGES, progress=progress, sleep=0)
         dst.commit()
     finally:
         dst.close()
@@ -48,6 +63,53 @@ def copy_horos_db_consistent(config: BackupConfig) -> str:
     return str(paths.dbcopy_path)
 
 
+# Indexes added to the disposable snapshot (never to the live Horos DB):
+# a covering index for the candidate modality scan and the join keys used
+# when fetching image paths for a batch. The batch ORDER BY sorts
+# COALESCE()d ZSTUDY columns of the candidate rows, which no plain column
+# index can serve, so ZSTUDY gets none.
+SNAPSHOT_INDEXES = (
+    ("idx_series_mod_study", "CREATE INDEX IF NOT EXISTS idx_series_mod_study ON ZSERIES(ZMODALITY, ZSTUDY);"),
+    ("idx_series_study", "CREATE INDEX IF NOT EXISTS idx_series_study ON ZSERIES(ZSTUDY);"),
+    ("idx_image_series", "CREATE INDEX IF NOT EXISTS idx_image_series ON ZIMAGE(ZSERIES);"),
+)
+
+# Rows sampled per index by ANALYZE; keeps it cheap on large Horos DBs.
+ANALYZE_LIMIT = 1000
+
+
+def ensure_snapshot_indexes(
+    db_path: str, logger: Optional[logging.Logger] = None, conn: Optional[sqlite3.Connection] = None
+) -> None:
+    """
+    Create the query indexes on the snapshot copy and refresh planner stats.
+
+    Uses ``conn`` when given (it must be writable and is left open), so the
+    caller can keep querying with a warm page cache; otherwise the snapshot
+    is opened just for the DDL. ``ANALYZE`` only runs when an index had to be
+    created, so a reused snapshot costs a single catalog lookup. Failures are
+    logged and otherwise ignored since the indexes only speed things up.
+    """
+    log = logger or logging.getLogger("horos_backup")
+    try:
+        own = conn is None
+        c = sqlite3.connect(db_path) if own else conn
+        try:
+            existing = {r[0] for r in c.execute("SELECT name FROM sqlite_master WHERE type='index'")}
+            missing = [ddl for name, ddl in SNAPSHOT_INDEXES if name not in existing]
+            for ddl in missing:
+                c.execute(ddl)
+            if missing:
+                c.execute(f"PRAGMA analysis_limit={ANALYZE_LIMIT};")
+                c.execute("ANALYZE;")
+            c.commit()
+        finally:
+            if own:
+                c.close()
+    except Exception as e:
+        log.warning("Could not create snapshot indexes on %s: %s", db_path, e)
+
+
 def _log_snapshot(log: logging.Logger, msg: str, path: str) -> None:
     try:
         st = os.stat(path)
@@ -56,13 +118,67 @@ def _log_snapshot(log: logging.Logger, msg: str, path: str) -> None:
         log.info(msg, path)
 
 
+def source_signature(config: BackupConfig) -> Optional[str]:
+    """
+    Describe the live Horos DB by size and mtime of the main file and its WAL.
+
+    Horos writes through WAL, so new studies may only touch ``-wal`` until the
+    next checkpoint; both files are part of the signature. Returns ``None`` if
+    the main file cannot be stat'ed.
+    """
+    parts = []
+    for suffix in ("", "-wal"):
+        try:
+            st = os.stat(f"{config.paths.horos_db_orig}{suffix}")
+        except FileNotFoundError:
+            if not suffix:
+                return None
+            continue
+        parts.append(f"{suffix or 'db'}:{st.st_size}:{st.st_mtime_ns}")
+    return ";".join(parts)
+
+
+def _stored_signature(config: BackupConfig, log: logging.Logger) -> Optional[str]:
+    try:
+        conn = state_connect(config)
+        try:
+            return get_snapshot_signature(conn)
+        finally:
+            conn.close()
+    except Exception as e:
+        log.debug("Could not read snapshot signature: %s", e)
+        return None
+
+
+def _store_signature(config: BackupConfig, signature: Optional[str], log: logging.Logger) -> None:
+    if signature is None:
+        return
+    try:
+        conn = state_connect(config)
+        try:
+            set_snapshot_signature(conn, signature)
+        finally:
+            conn.close()
+    except Exception as e:
+        log.debug("Could not store snapshot signature: %s", e)
+
+
 def choose_db_path(config: BackupConfig, logger: Optional[logging.Logger] = None) -> str:
     log = logger or logging.getLogger("horos_backup")
     use_copy = config.settings.use_db_copy
 
     if use_copy:
-        # Always create a fresh snapshot when configured to do so.
+        # Fresh snapshot each run, unless the live DB has not changed since the last copy.
+        signature = source_signature(config)
+        if (
+            signature is not None
+            and config.paths.dbcopy_path.exists()
+            and _stored_signature(config, log) == signature
+        ):
+            _log_snapshot(log, "Horos DB unchanged; reusing snapshot: %s", str(config.paths.dbcopy_path))
+            return str(config.paths.dbcopy_path)
         dbp = copy_horos_db_consistent(config)
+        _store_signature(config, signature, log)
         _log_snapshot(log, "Snapshot created: %s", dbp)
         return dbp
 
@@ -77,4 +193,10 @@ def choose_db_path(config: BackupConfig, logger: Optional[logging.Logger] = None
     return dbp
 
 
-__all__ = ["copy_horos_db_consistent", "choose_db_path"]
\ No newline at end of file
+__all__ = [
+    "copy_horos_db_consistent",
+    "choose_db_path",
+    "ensure_snapshot_indexes",
+    "source_signature",
+    "SNAPSHOT_INDEXES",
+]
\ No newline at end of file
@@ -9,21 +9,27 @@
 """Filesystem helpers for the Horos backup pipeline."""
 from __future__ import annotations
 
+import functools
 import logging
 import os
 import shutil
+import stat as _stat
+import subprocess
 from pathlib import Path
-from typing import Optional
+from typing import FrozenSet, Optional, Tuple
 
 from .config import BackupConfig
 
 
 def ensure_dirs(config: BackupConfig):
     paths = config.paths
-    # Ensure all directories exist before the run touches files.
-    paths.backup_root.mkdir(parents=True, exist_ok=True)
-    paths.tmp_root.mkdir(parents=True, exist_ok=True)
-    paths.dbcopy_dir.mkdir(parents=True, exist_ok=True)
+    # Ensure all directories exist before the run touches files. With the
+    # default layout dbcopy_dir sits under tmp_root under backup_root, so only
+    # the deepest leaves need a mkdir; parents=True creates the rest.
+    wanted = (paths.backup_root, paths.tmp_root, paths.dbcopy_dir)
+    for d in wanted:
+        if not any(d in other.parents for other in wanted):
+            d.mkdir(parents=True, exist_ok=True)
 
 
 def ensure_volume_mounted(config: BackupConfig):
@@ -37,83 +43,186 @@ def ensure_volume_mounted(config: BackupConfig):
         RuntimeError: If either the PACS root does not exist or the sentinel file is missing.
     """
     paths = config.paths
-    # Guard against running on the wrong disk by checking the sentinel.
-    if not paths.pacs_root.exists() or not paths.sentinel.exists():
+    # Guard against running on the wrong disk by checking the sentinel. It
+    # lives inside pacs_root, so one stat() answers both checks.
+    try:
+        os.stat(paths.sentinel)
+        return
+    except (OSError, ValueError):
         raise RuntimeError(
             f"External volume not mounted OR sentinel missing: {paths.pacs_root}\n"
             f"Create the sentinel file: {paths.sentinel}"
-        )
+        ) from None
 
 
 def count_files_early(root: Path, stop_after: int) -> int:
-    """Iteratively count files, aborting as soon as ``stop_after`` is exceeded."""
+    """
+    Count regular files under ``root``, stopping once ``stop_after`` is exceeded.
+
+    The walk is delegated to ``find(1)`` so per-entry work happens in C; its
+    NUL-separated output is counted in chunks and the process is terminated as
+    soon as the threshold is crossed. Falls back to a Python walk when ``find``
+    cannot be launched. Counts above the threshold are reported as
+    ``stop_after + 1``.
+    """
     if not root.exists():
         return 0
+    try:
+        return _count_files_find(root, stop_after)
+    except OSError:
+        return _count_files_walk(root, stop_after)
+
+
+def _count_files_find(root: Path, stop_after: int) -> int:
+    proc = subprocess.Popen(
+        ["find", str(root), "-type", "f", "-print0"],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+    )
+    count = 0
+    try:
+        while True:
+            chunk = proc.stdout.read1(1 << 16)
+            if not chunk:
+                break
+            count += chunk.count(b"\0")
+            # Bail out quickly once we cross the threshold.
+            if count > stop_after:
+                return stop_after + 1
+    finally:
+        if proc.poll() is None:
+            proc.terminate()
+        proc.stdout.close()
+        proc.wait()
+    return count
+
 
+def _count_files_walk(root: Path, stop_after: int) -> int:
     count = 0
-    stack = [root]
+    # Plain strings: entry.path is already a str, so no Path per directory.
+    stack = [os.fspath(root)]
+    push = stack.append
+    pop = stack.pop
     while stack:
-        d = stack.pop()
+        d = pop()
+        # One handler per directory: d_type makes the is_file/is_dir checks
+        # syscall-free, so the realistic failure is the directory vanishing.
         try:
             with os.scandir(d) as it:
                 for entry in it:
-                    try:
+                    if entry.is_file(follow_symlinks=False):
+                        count += 1
                         # Bail out quickly once we cross the threshold.
-                        if entry.is_file(follow_symlinks=False):
-                            count += 1
-                            if count > stop_after:
-                                return count
-                        elif entry.is_dir(follow_symlinks=False):
-                            stack.append(Path(entry.path))
-                    except FileNotFoundError:
-                        pass
+                        if count > stop_after:
+                            return count
+                    elif entry.is_dir(follow_symlinks=False):
+                        push(entry.path)
         except FileNotFoundError:
             pass
     return count
 
 
-def resolve_image_path(zpathstring, zpathnumber, zstored_in_dbfolder, config: BackupConfig) -> Path:
+def _is_regular_entry(entry: os.DirEntry) -> bool:
+    try:
+        # d_type answers this without a stat(); only symlinks are followed.
+        return entry.is_file()
+    except OSError:
+        return False
+
+
+@functools.lru_cache(maxsize=4096)
+def _listdir_set(dirpath: str) -> FrozenSet[str]:
+    # One directory read answers "is a regular file" for every image stored in it.
+    try:
+        with os.scandir(dirpath) as it:
+            return frozenset(e.name for e in it if _is_regular_entry(e))
+    except OSError:
+        return frozenset()
+
+
+def clear_listdir_cache():
+    """Forget cached directory listings so the next batch sees fresh contents."""
+    _listdir_set.cache_clear()
+
+
+def _isreg(path_str: str) -> bool:
+    # Path.is_file() without the PurePath wrapping; still follows symlinks like it.
+    try:
+        return _stat.S_ISREG(os.stat(path_str).st_mode)
+    except (OSError, ValueError):
+        return False
+
+
+def resolve_image_path(zpathstring, zpathnumber, zstored_in_dbfolder, config: BackupConfig) -> Tuple[Path, bool]:
     """
     Resolve the physical path for a ZIMAGE entry.
 
     Behavior matches the original monolithic script and checks multiple
     candidates under ``DATABASE.noindex`` before falling back to absolute
     paths.
+
+    Returns ``(path, exists)`` so callers reuse the existence check instead
+    of stat'ing the winner again; on a miss the first candidate is returned
+    with ``exists=False``.
     """
+    path, exists = resolve_image_path_str(zpathstring, zpathnumber, zstored_in_dbfolder, config)
+    return Path(path), exists
+
+
+def resolve_image_path_str(zpathstring, zpathnumber, zstored_in_dbfolder, config: BackupConfig) -> Tuple[str, bool]:
+    # Same as resolve_image_path but returns a plain string: the per-image
+    # loop in run_once hands paths straight to the zip workers, and building
+    # a Path per hit cost more than the listing lookup itself.
     paths = config.paths
-    try:
-        in_db = int(zstored_in_dbfolder) == 1
-    except Exception:
+    # SQLite returns the flag as an int; only odd shapes need int().
+    if zstored_in_dbfolder == 1:
+        in_db = True
+    elif zstored_in_dbfolder is None or zstored_in_dbfolder == 0:
         in_db = False
+    else:
+        try:
+            in_db = int(zstored_in_dbfolder) == 1
+        except Exception:
+            in_db = False
 
     s_raw = zpathstring or ""
     s = str(s_raw).lstrip("/")
     sub = (str(zpathnumber).strip() if zpathnumber is not None else "")
 
+    # Candidates are plain strings, and so is the winner.
+    db_dir = str(paths.database_dir)
     candidates = []
     if in_db:
+        # Fast path: most images of a study share one DATABASE.noindex/<sub>
+        # folder, so check the cached listing instead of stat'ing each file.
+        parent = os.path.join(db_dir, sub) if sub else db_dir
+        head, name = os.path.split(s)
+        if head:
+            parent = os.path.join(parent, head)
+        if name and name in _listdir_set(parent):
+            return os.path.join(parent, name), True
+
         # Typical case: files live under DATABASE.noindex and may be nested.
+        # The likeliest candidate is probed before the others are built.
+        first = os.path.join(db_dir, sub, s) if sub else os.path.join(db_dir, s)
+        if _isreg(first):
+            return first, True
         if sub:
-            candidates.append(paths.database_dir / sub / s)
-        candidates.append(paths.database_dir / s)
-        p_abs = Path(s_raw)
-        if p_abs.is_absolute():
-            candidates.append(p_abs)
+            candidates.append(os.path.join(db_dir, s))
+        s_abs = str(s_raw)
+        if os.path.isabs(s_abs):
+            candidates.append(s_abs)
     else:
-        p = Path(s_raw)
-        if p.is_absolute():
-            candidates.append(p)
-        else:
-            # Relative paths outside DATABASE.noindex are rooted at Horos Data.
-            candidates.append(paths.horos_data_dir / s)
+        s_abs = str(s_raw)
+        # Relative paths outside DATABASE.noindex are rooted at Horos Data.
+        first = s_abs if os.path.isabs(s_abs) else os.path.join(str(paths.horos_data_dir), s)
+        if _isreg(first):
+            return first, True
 
     for c in candidates:
-        try:
-            if c.is_file():
-                return c
-        except Exception:
-            pass
-    return candidates[0]
+        if _isreg(c):
+            return c, True
+    return first, False
 
 
 def dump_fs_layout(config: BackupConfig, logger: Optional[logging.Logger] = None):
@@ -124,15 +233,23 @@ def dump_fs_layout(config: BackupConfig, logger: Optional[logging.Logger] = None
         config (BackupConfig): Configuration object providing filesystem paths; this function inspects `config.paths.horos_data_dir` and `config.paths.database_dir`.
     
     Notes:
-        Any exceptions raised while inspecting the filesystem are caught and logged.
+        Does nothing unless the logger has DEBUG enabled. Any exceptions raised while inspecting the filesystem are caught and logged.
     """
     log = logger or logging.getLogger("horos_backup")
+    # Everything below is debug output; skip the stats and the scan when it would be dropped.
+    if not log.isEnabledFor(logging.DEBUG):
+        return
     try:
         # Helpful debug to understand what the PACS volume looks like in situ.
-        log.debug("FS layout check:")
-        log.debug("  HOROS_DATA_DIR exists=%s path=%s", config.paths.horos_data_dir.exists(), config.paths.horos_data_dir)
-        log.debug("  DATABASE_DIR   exists=%s path=%s", config.paths.database_dir.exists(), config.paths.database_dir)
-        if config.paths.database_dir.exists():
+        db_exists = config.paths.database_dir.exists()
+        log.debug(
+            "FS layout check:\n  HOROS_DATA_DIR exists=%s path=%s\n  DATABASE_DIR   exists=%s path=%s",
+            config.paths.horos_data_dir.exists(),
+            config.paths.horos_data_dir,
+            db_exists,
+            config.paths.database_dir,
+        )
+        if db_exists:
             subdirs = []
             with os.scandir(config.paths.database_dir) as it:
                 for entry in it:
@@ -148,6 +265,19 @@ def dump_fs_layout(config: BackupConfig, logger: Optional[logging.Logger] = None
         log.exception("dump_fs_layout failed")
 
 
+def _is_month_dir_name(name: str) -> bool:
+    # Same set as the glob "[0-9][0-9][0-9][0-9]_[0-1][0-9]": isascii() keeps
+    # isdigit() to ASCII digits. Plain str checks, no regex match per entry.
+    return (
+        len(name) == 7
+        and name[4] == "_"
+        and name[5] in "01"
+        and name.isascii()
+        and name[:4].isdigit()
+        and name[6].isdigit()
+    )
+
+
 def latest_incomplete_month_folder(config: BackupConfig) -> Optional[Path]:
     """
     Return the newest month-format directory under config.paths.backup_root that does not contain a .month_done marker.
@@ -157,12 +287,25 @@ def latest_incomplete_month_folder(config: BackupConfig) -> Optional[Path]:
     Returns:
         Path or None: The latest incomplete month directory, or `None` if no matching directory exists or the latest is already marked complete.
     """
-    months = [p for p in config.paths.backup_root.glob("[0-9][0-9][0-9][0-9]_[0-1][0-9]") if p.is_dir()]
-    if not months:
+    # Single scandir pass keeping the max name; same-length YYYY_MM names sort chronologically.
+    root = config.paths.backup_root
+    latest_name = None
+    try:
+        with os.scandir(root) as it:
+            for entry in it:
+                name = entry.name
+                if (latest_name is None or name > latest_name) and _is_month_dir_name(name):
+                    try:
+                        if entry.is_dir():
+                            latest_name = name
+                    except OSError:
+                        pass
+    except OSError:
+        return None
+    if latest_name is None:
         return None
-    latest = sorted(months)[-1]
-    if not (latest / ".month_done").exists():
-        return latest
+    if not os.path.exists(os.path.join(root, latest_name, ".month_done")):
+        return root / latest_name
     return None
 
 
@@ -183,6 +326,9 @@ def reset_incomplete_latest_month(config: BackupConfig, logger: Optional[logging
         shutil.rmtree(mf, ignore_errors=True)
 
 
+_MARKER_FLAGS = os.O_WRONLY | os.O_CREAT | getattr(os, "O_CLOEXEC", 0)
+
+
 def mark_month_done(month_dir: Path, logger: Optional[logging.Logger] = None):
     """
     Create a completion marker for a month folder so future runs treat it as finished.
@@ -190,10 +336,17 @@ def mark_month_done(month_dir: Path, logger: Optional[logging.Logger] = None):
     Creates the month directory if missing and writes an empty file named ".month_done" inside it. If an error occurs the function logs a warning but does not raise.
     """
     log = logger or logging.getLogger("horos_backup")
+    marker = os.path.join(month_dir, ".month_done")
     try:
         # Marker file lets future runs skip deletion of already completed months.
-        month_dir.mkdir(parents=True, exist_ok=True)
-        (month_dir / ".month_done").touch()
+        # The folder normally holds the ZIPs just written, so create the marker
+        # directly and only fall back to mkdir when it is genuinely missing.
+        try:
+            fd = os.open(marker, _MARKER_FLAGS, 0o644)
+        except FileNotFoundError:
+            month_dir.mkdir(parents=True, exist_ok=True)
+            fd = os.open(marker, _MARKER_FLAGS, 0o644)
+        os.close(fd)
     except Exception as e:
         log.warning("Failed to mark .month_done in %s: %s", month_dir, e)
 
@@ -203,6 +356,8 @@ __all__ = [
     "ensure_volume_mounted",
     "count_files_early",
     "resolve_image_path",
+    "resolve_image_path_str",
+    "clear_listdir_cache",
     "dump_fs_layout",
     "latest_incomplete_month_folder",
     "reset_incomplete_latest_month",
@@ -9,36 +9,256 @@
 """Issues CSV logging."""
 from __future__ import annotations
 
+import atexit
 import csv
-from datetime import datetime
+import io
+import logging
+import os
+import queue
+import threading
+import time
+from pathlib import Path
 from typing import Dict, Optional
 
 from .config import BackupConfig
 
+ISSUES_HEADER = ["timestamp", "kind", "study_uid", "detail", "extra"]
+# Characters of formatted rows gathered before a write, and how often
+# queued rows reach the file regardless.
+ISSUES_BUFFER_SIZE = 1 << 16
+ISSUES_FLUSH_INTERVAL = 1.0
+# How long run_once waits for queued rows before releasing the run lock,
+# and how long the exit hook waits for each writer to stop.
+ISSUES_FLUSH_TIMEOUT = 5.0
+# Upper bound on rows handed to one writerows() call.
+ISSUES_BATCH_ROWS = 256
+
+# O_APPEND: each os.write lands at the current end of the file.
+_ISSUES_OPEN_FLAGS = os.O_WRONLY | os.O_CREAT | os.O_APPEND | getattr(os, "O_CLOEXEC", 0)
+_HEADER_LINE = (",".join(ISSUES_HEADER) + "\r\n").encode("utf-8")
+
+_STOP = object()
+
+
+class _IssuesWriter:
+    """
+    Background thread that owns one ``issues.csv``.
+
+    Queued rows are formatted in ``writerows()`` batches of up to
+    ``ISSUES_BATCH_ROWS`` into an in-memory buffer, which reaches the file
+    in one ``os.write`` on an ``O_APPEND`` descriptor once it holds
+    ``ISSUES_BUFFER_SIZE`` characters, after a one-second tick, on
+    ``flush()`` and on stop. Bytes a failed write did not get out (e.g. the
+    volume went away) are kept and retried on the next drain.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.q: "queue.Queue" = queue.Queue()
+        self._fd: Optional[int] = None
+        self._buf = io.StringIO(newline="")
+        # Encoded rows not yet on disk; kept across failed writes.
+        self._unwritten = b""
+        self._csv = csv.writer(self._buf)
+        self._thread = threading.Thread(target=self._run, name="issues-writer", daemon=True)
+        self._thread.start()
+
+    def _open(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._fd = os.open(str(self.path), _ISSUES_OPEN_FLAGS, 0o644)
+        # Header only for a brand-new (empty) file.
+        if os.fstat(self._fd).st_size == 0:
+            _write_all(self._fd, _HEADER_LINE)
+
+    def _drain(self):
+        text = self._buf.getvalue()
+        if text:
+            self._buf.seek(0)
+            self._buf.truncate()
+            self._unwritten += text.encode("utf-8")
+        data = self._unwritten
+        if not data:
+            return
+        written = 0
+        view = memoryview(data)
+        try:
+            if self._fd is None:
+                self._open()
+            while written < len(data):
+                written += os.write(self._fd, view[written:])
+        except OSError:
+            # Reopen on the next attempt (the volume may have come back).
+            if self._fd is not None:
+                try:
+                    os.close(self._fd)
+                except OSError:
+                    pass
+                self._fd = None
+            raise
+        finally:
+            view.release()
+            # Only what reached the file leaves the buffer; the rest is retried.
+            self._unwritten = data[written:]
+
+    def _drain_logged(self):
+        try:
+            self._drain()
+        except Exception:
+            logging.getLogger("horos_backup").exception(
+                "Failed to write issue rows to %s (%d bytes kept for retry)", self.path, len(self._unwritten)
+            )
+
+    def _run(self):
+        carried = None
+        try:
+            while True:
+                if carried is not None:
+                    item, carried = carried, None
+                else:
+                    try:
+                        item = self.q.get(timeout=ISSUES_FLUSH_INTERVAL)
+                    except queue.Empty:
+                        self._drain_logged()
+                        continue
+                if item is _STOP:
+                    break
+                if isinstance(item, threading.Event):
+                    # flush() barrier: everything queued before it is on disk.
+                    self._drain_logged()
+                    item.set()
+                    continue
+                # Drain whatever else is already queued and format it with one
+                # writerows() call; a control item ends the batch and is
+                # handled next, so ordering holds.
+                batch = [item]
+                while len(batch) < ISSUES_BATCH_ROWS:
+                    try:
+                        nxt = self.q.get_nowait()
+                    except queue.Empty:
+                        break
+                    if nxt is _STOP or isinstance(nxt, threading.Event):
+                        carried = nxt
+                        break
+                    batch.append(nxt)
+                mark = self._buf.tell()
+                try:
+                    self._csv.writerows(batch)
+                except Exception:
+                    # A row that cannot be formatted must not stop the thread
+                    # (flush() would never return): redo the batch row by row
+                    # so only the bad rows are dropped.
+                    self._buf.seek(mark)
+                    self._buf.truncate()
+                    for row in batch:
+                        try:
+                            self._csv.writerow(row)
+                        except Exception:
+                            logging.getLogger("horos_backup").exception(
+                                "Failed to format issue row for %s", self.path
+                            )
+                if self._buf.tell() >= ISSUES_BUFFER_SIZE:
+                    self._drain_logged()
+        finally:
+            self._drain_logged()
+            if self._fd is not None:
+                os.close(self._fd)
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        done = threading.Event()
+        self.q.put(done)
+        return done.wait(timeout)
+
+    def stop(self, timeout: Optional[float] = None):
+        self.q.put(_STOP)
+        self._thread.join(timeout)
+
+
+def _write_all(fd: int, data: bytes):
+    # os.write may return early on a full pipe/volume; finish the record.
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+
+_WRITERS: Dict[Path, _IssuesWriter] = {}
+_WRITERS_LOCK = threading.Lock()
+
+
+def _writer_for(path: Path) -> _IssuesWriter:
+    # Lock-free hit (dict.get is atomic); the lock only serializes creation,
+    # so concurrent workers never start two writers for one file.
+    writer = _WRITERS.get(path)
+    if writer is not None:
+        return writer
+    with _WRITERS_LOCK:
+        writer = _WRITERS.get(path)
+        if writer is None:
+            writer = _WRITERS[path] = _IssuesWriter(path)
+        return writer
+
+
+# (epoch second, formatted stamp); rebuilt once per second, not per row.
+# Rebinding one tuple keeps concurrent readers consistent.
+_ts_cache = (-1, "")
+
+
+def _timestamp() -> str:
+    global _ts_cache
+    now = int(time.time())
+    cached = _ts_cache
+    if cached[0] != now:
+        # Same text as datetime.now().isoformat(timespec="seconds").
+        cached = _ts_cache = (now, time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(now)))
+    return cached[1]
+
 
 def issues_log(
     config: BackupConfig, kind: str, study_uid: str, detail: str = "", extra: Optional[Dict] = None
 ):
     """
     Append an issue row to ``issues.csv``.
+
+    The row is queued for a background writer, so callers (including the
+    study worker threads) never wait on the external volume; call
+    ``flush_issues()`` to make queued rows durable.
+    """
+    _writer_for(config.paths.issues_csv).q.put(
+        [
+            _timestamp(),
+            kind,
+            study_uid,
+            detail,
+            (extra and str(extra)) or "",
+        ]
+    )
+
+
+def flush_issues(timeout: Optional[float] = None) -> bool:
+    """
+    Block until every queued issue row has been written and flushed.
+
+    ``timeout`` bounds the wait per writer; returns ``False`` if any writer
+    did not confirm in time.
     """
-    issues_csv = config.paths.issues_csv
-    # Ensure the file exists and has a header before appending.
-    issues_csv.parent.mkdir(parents=True, exist_ok=True)
-    new_file = not issues_csv.exists()
-    with open(issues_csv, "a", newline="", encoding="utf-8") as f:
-        w = csv.writer(f)
-        if new_file:
-            w.writerow(["timestamp", "kind", "study_uid", "detail", "extra"])
-        w.writerow(
-            [
-                datetime.now().isoformat(timespec="seconds"),
-                kind,
-                study_uid,
-                detail,
-                (extra and str(extra)) or "",
-            ]
-        )
-
-
-__all__ = ["issues_log"]
+    with _WRITERS_LOCK:
+        writers = list(_WRITERS.values())
+    flushed = True
+    for writer in writers:
+        flushed = writer.flush(timeout) and flushed
+    return flushed
+
+
+def close_issues(timeout: Optional[float] = None):
+    """Drain and stop all issue writers (registered with ``atexit``)."""
+    with _WRITERS_LOCK:
+        writers = list(_WRITERS.values())
+        _WRITERS.clear()
+    for writer in writers:
+        writer.stop(timeout)
+
+
+# Bounded: a writer stuck on an unresponsive volume must not hang process exit.
+atexit.register(close_issues, ISSUES_FLUSH_TIMEOUT)
+
+
+__all__ = ["issues_log", "flush_issues", "close_issues", "ISSUES_HEADER", "ISSUES_FLUSH_TIMEOUT"]
@@ -9,34 +9,67 @@
 """File lock utilities to avoid overlapping runs."""
 from __future__ import annotations
 
+import errno
 import fcntl
 import os
+import struct
 from pathlib import Path
+from typing import Optional
 
+_LOCK_FLAGS = os.O_RDWR | os.O_CREAT | getattr(os, "O_CLOEXEC", 0)
+# Open-file-description locks (Linux >= 3.15) belong to the descriptor rather
+# than the process; macOS lacks them and keeps using flock().
+_F_OFD_SETLK = getattr(fcntl, "F_OFD_SETLK", None)
 
-def acquire_lock(lock_path: Path):
+
+def _try_lock(fd: int) -> bool:
+    if _F_OFD_SETLK is not None:
+        # struct flock: l_type, l_whence, l_start, l_len (0 = whole file), l_pid (must be 0).
+        lk = struct.pack("hhqqi", fcntl.F_WRLCK, os.SEEK_SET, 0, 0, 0)
+        try:
+            fcntl.fcntl(fd, _F_OFD_SETLK, lk)
+            return True
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EACCES):
+                return False
+            if e.errno != errno.EINVAL:
+                raise
+            # Kernel without OFD support: fall through to flock().
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return True
+    except BlockingIOError:
+        return False
+
+
+def acquire_lock(lock_path: Path) -> Optional[int]:
+    """
+    Try to take the run lock without blocking.
+
+    Returns the locked file descriptor, or ``None`` when another run holds
+    the lock: overlapping runs are skipped, never queued. The descriptor is
+    opened with ``O_CLOEXEC`` so child processes do not inherit it.
+    """
     # Create parent directories to avoid race on first run.
     lock_path.parent.mkdir(parents=True, exist_ok=True)
-    f = open(lock_path, "w")
+    fd = os.open(str(lock_path), _LOCK_FLAGS, 0o644)
     try:
         # Non-blocking exclusive lock to skip runs when another is active.
-        fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
-        f.truncate(0)
-        f.write(str(os.getpid()))
-        f.flush()
-        return f
-    except BlockingIOError:
-        f.close()
-        return None
+        if not _try_lock(fd):
+            os.close(fd)
+            return None
+        os.ftruncate(fd, 0)
+        os.write(fd, str(os.getpid()).encode())
+        return fd
+    except BaseException:
+        os.close(fd)
+        raise
 
 
-def release_lock(fh):
-    try:
-        fcntl.flock(fh.fileno(), fcntl.LOCK_UN)
-    except Exception:
-        pass
+def release_lock(fd: int):
+    # Closing the descriptor drops either kind of lock.
     try:
-        fh.close()
+        os.close(fd)
     except Exception:
         pass
 
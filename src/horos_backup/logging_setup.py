@@ -7,29 +7,229 @@
 # Thales Matheus Mendonça Santos - November 2025
 #
 """Logging configuration helpers."""
+import atexit
+import gzip
 import logging
+import os
+import queue
+import shutil
 import sys
-from logging.handlers import RotatingFileHandler
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from typing import Dict, List, Optional, Tuple
 
 from .config import BackupConfig
 
+# Size of the userspace buffer in front of the log file.
+LOG_BUFFER_SIZE = 1 << 16
+# Seconds between background flushes of buffered records.
+FLUSH_INTERVAL = 5.0
+
+# Background listeners keyed by logger name, so they can be drained on exit.
+_LISTENERS: Dict[str, QueueListener] = {}
+
+
+class BufferedRotatingFileHandler(RotatingFileHandler):
+    """
+    RotatingFileHandler that lets a 64 KiB stream buffer coalesce records.
+
+    ``StreamHandler.emit`` flushes after every record; here the flush is
+    deferred to close/rollover (closing the stream writes out the buffer
+    before the file is renamed), to ``WARNING`` and above, to a timer every
+    ``FLUSH_INTERVAL`` seconds, or to an explicit ``flush()`` call. The
+    rollover check counts bytes written instead of seeking/stat'ing the file
+    on every record.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._deferring = False
+        self._bytes_written = 0
+        super().__init__(*args, **kwargs)
+        self._stop_flusher = threading.Event()
+        self._flusher = threading.Thread(target=self._flush_periodically, name="log-flush", daemon=True)
+        self._flusher.start()
+
+    def _open(self):
+        stream = open(
+            self.baseFilename,
+            self.mode,
+            buffering=LOG_BUFFER_SIZE,
+            encoding=self.encoding,
+            errors=getattr(self, "errors", None),
+        )
+        self._bytes_written = os.fstat(stream.fileno()).st_size
+        return stream
+
+    def _flush_periodically(self):
+        while not self._stop_flusher.wait(FLUSH_INTERVAL):
+            self.flush()
+
+    def shouldRollover(self, record):
+        if self.stream is None:
+            self.stream = self._open()
+        if self.maxBytes <= 0:
+            return False
+        msg = "%s\n" % self.format(record)
+        size = len(msg) if msg.isascii() else len(msg.encode(self.encoding or "utf-8", "replace"))
+        if self._bytes_written + size >= self.maxBytes:
+            return True
+        self._bytes_written += size
+        return False
+
+    def emit(self, record):
+        self._deferring = True
+        try:
+            super().emit(record)
+        finally:
+            self._deferring = False
+        if record.levelno >= logging.WARNING:
+            # Problems should reach the file right away, even mid-batch.
+            self.flush()
+
+    def flush(self):
+        if not self._deferring:
+            super().flush()
+
+    def close(self):
+        self._stop_flusher.set()
+        super().close()
+
+
+class AsyncRotatingFileHandler(BufferedRotatingFileHandler):
+    """
+    Buffered rotating handler that gzips rolled files on a background thread.
+
+    Rollover itself is just renames; compressing a 100 MB log would otherwise
+    stall the logging thread, so it is handed to a single worker. Backups are
+    named ``<log>.N.gz``. A new rollover waits for the previous compression so
+    the rename chain never races the worker.
+
+    Plain ``<log>.N`` backups left by earlier versions are gzipped into the
+    same chain when the handler starts. If a compression fails, the rolled
+    file is kept uncompressed and the failure is logged at the next rollover
+    (or on close).
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.namer = self._gz_namer
+        self.rotator = self._gz_rotator
+        self._rotate_lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="log-gzip")
+        self._pending: List[Tuple[Future, str]] = []
+        self._migrate_plain_backups()
+
+    @staticmethod
+    def _gz_namer(name: str) -> str:
+        return name + ".gz"
+
+    @staticmethod
+    def _compress(src: str, dest: str):
+        part = dest + ".part"
+        try:
+            with open(src, "rb") as f_in, gzip.open(part, "wb", compresslevel=1) as f_out:
+                shutil.copyfileobj(f_in, f_out, 1 << 20)
+            os.replace(part, dest)
+        except BaseException:
+            # Keep src: it is the only copy of those records.
+            try:
+                os.remove(part)
+            except OSError:
+                pass
+            raise
+        os.remove(src)
+
+    def _submit(self, src: str, dest: str):
+        self._pending.append((self._executor.submit(self._compress, src, dest), src))
+
+    def _migrate_plain_backups(self):
+        # Uncompressed <log>.N files from before the .gz chain would never be
+        # rotated (or expired) again; fold each into its free .N.gz slot.
+        for i in range(1, self.backupCount + 1):
+            plain = "%s.%d" % (self.baseFilename, i)
+            if os.path.exists(plain) and not os.path.exists(self.rotation_filename(plain)):
+                self._submit(plain, self.rotation_filename(plain))
+
+    def _gz_rotator(self, source: str, dest: str):
+        # Atomic rename now; the slow gzip happens off-thread. The staging
+        # name cannot collide with a plain <log>.N backup or with a file kept
+        # after an earlier failed compression.
+        staged = "%s.%d.tmp" % (dest, time.time_ns())
+        os.replace(source, staged)
+        self._submit(staged, dest)
+
+    def _wait_pending(self) -> List[str]:
+        failures = []
+        for fut, src in self._pending:
+            try:
+                fut.result()
+            except Exception as e:
+                failures.append("Failed to gzip rotated log %s (kept uncompressed): %s" % (src, e))
+        self._pending = []
+        return failures
+
+    def _report(self, failures: List[str]):
+        # Goes through handle() like any record; called without
+        # _rotate_lock held, since it may itself trigger a rollover.
+        for msg in failures:
+            self.handle(
+                logging.makeLogRecord(
+                    {"name": "horos_backup", "levelno": logging.ERROR, "levelname": "ERROR", "msg": msg}
+                )
+            )
+
+    def doRollover(self):
+        with self._rotate_lock:
+            failures = self._wait_pending()
+            super().doRollover()
+        self._report(failures)
+
+    def close(self):
+        with self._rotate_lock:
+            failures = self._wait_pending()
+        self._report(failures)
+        self._executor.shutdown(wait=True)
+        super().close()
+
+
+def stop_logging(logger_name: str = "horos_backup"):
+    """Drain the queued records for ``logger_name`` and flush its handlers."""
+    listener = _LISTENERS.pop(logger_name, None)
+    if listener is None:
+        return
+    listener.stop()
+    for h in listener.handlers:
+        h.flush()
+
 
 def setup_logging(config: BackupConfig, logger_name: str = "horos_backup") -> logging.Logger:
     """
     Configure a rotating file handler + stdout handler.
-    Safe to call multiple times; existing handlers are reused.
+    Safe to call multiple times; existing handlers are reused. The level
+    comes from ``settings.log_level`` (INFO unless ``HOROS_LOG_LEVEL`` says
+    otherwise); unknown names fall back to INFO.
+
+    The logger itself only enqueues records: ``QueueHandler.prepare()``
+    merges the message arguments (and any traceback) on the logging thread,
+    while a ``QueueListener`` thread applies the handlers' formatters and
+    does the file/stdout I/O, so log writes stay off the export loop.
     """
     logger = logging.getLogger(logger_name)
     if logger.handlers:
         return logger
 
-    logger.setLevel(logging.DEBUG)
+    # The logger level is the single gate: DEBUG-only work in the pipeline
+    # checks isEnabledFor(DEBUG), so it is skipped entirely at INFO.
+    level = logging.getLevelName(str(config.settings.log_level).upper())
+    logger.setLevel(level if isinstance(level, int) else logging.INFO)
 
     paths = config.paths
     # Make sure the backup folder has a place for log rotation.
     paths.logs_dir.mkdir(parents=True, exist_ok=True)
 
-    fh = RotatingFileHandler(
+    fh = AsyncRotatingFileHandler(
         str(paths.log_file),
         maxBytes=config.settings.log_max_bytes,
         backupCount=config.settings.log_backup_count,
@@ -42,9 +242,18 @@ def setup_logging(config: BackupConfig, logger_name: str = "horos_backup") -> lo
     ch.setLevel(logging.DEBUG)
     ch.setFormatter(logging.Formatter("%(asctime)s [%(levelname)s] %(message)s"))
 
-    logger.addHandler(fh)
-    logger.addHandler(ch)
+    # SimpleQueue: unbounded and lock-light on the producer side; the
+    # listener has no use for task_done()/join().
+    q = queue.SimpleQueue()
+    listener = QueueListener(q, fh, ch, respect_handler_level=True)
+    listener.start()
+    _LISTENERS[logger_name] = listener
+    # Runs before logging's own shutdown hook (atexit is LIFO), so queued
+    # records reach the handlers before they are closed.
+    atexit.register(stop_logging, logger_name)
+
+    logger.addHandler(QueueHandler(q))
     return logger
 
 
-__all__ = ["setup_logging"]
+__all__ = ["setup_logging", "stop_logging", "BufferedRotatingFileHandler", "AsyncRotatingFileHandler"]
@@ -9,20 +9,33 @@
 """Filename sanitization and ZIP naming helpers."""
 from __future__ import annotations
 
+import functools
+import os
 import re
 from pathlib import Path
+from typing import AbstractSet, Optional
 
 from .config import BackupConfig
 from .dates import fmt_date_for_name
 
 SANITIZE_RE = re.compile(r"[^0-9A-Za-z._-]+", re.UNICODE)
 
+# Same pattern in bytes mode for ASCII input: sre skips Unicode-aware
+# character handling, and it measured faster than a str.translate pass on
+# typical DICOM names (e.g. "DOE^JOHN").
+_SANITIZE_RE_BYTES = re.compile(rb"[^0-9A-Za-z._-]+")
 
+
+@functools.lru_cache(maxsize=4096)
 def sanitize_name(s: str) -> str:
+    # Memoized: the same patient name comes back for every study of that patient.
     # Replace spaces and unwanted chars with underscores, then clamp length.
     # DICOM strings can contain accents or symbols, so we keep it ASCII-safe.
     sanitized = (s or "").strip().replace(" ", "_")
-    sanitized = SANITIZE_RE.sub("_", sanitized)
+    if sanitized.isascii():
+        sanitized = _SANITIZE_RE_BYTES.sub(b"_", sanitized.encode("ascii")).decode("ascii")
+    else:
+        sanitized = SANITIZE_RE.sub("_", sanitized)
     return sanitized[:128] or "UNKNOWN"
 
 
@@ -33,10 +46,15 @@ def build_zip_path(
     study_ts,
     study_uid: str,
     config: BackupConfig,
+    reserved: Optional[AbstractSet[str]] = None,
 ) -> Path:
     """
     Generate a unique ZIP path keeping the full Study UID intact.
     The prefix may be truncated to respect ``max_name_noext``.
+
+    ``reserved`` holds paths (as strings) already handed out but not yet on
+    disk, e.g. earlier studies of a batch that are still being zipped; they
+    are treated as taken.
     """
     max_noext = config.settings.max_name_noext
 
@@ -46,24 +64,38 @@ def build_zip_path(
     uid = sanitize_name(study_uid)
 
     prefix = f"{patient}_{dob}_{sdate}"
-    base_noext = f"{prefix}_{uid}"
-
-    if len(base_noext) > max_noext:
-        # Keep full UID and shrink the prefix to fit under the configured cap.
-        allow_prefix = max(1, max_noext - (len(uid) + 1))
+    # Keep full UID and shrink the prefix to fit under the configured cap;
+    # the name is assembled once either way.
+    allow_prefix = max(1, max_noext - (len(uid) + 1))
+    if len(prefix) > allow_prefix:
         prefix = prefix[:allow_prefix].rstrip("_")
-        base_noext = f"{prefix}_{uid}"
+    base_noext = prefix + "_" + uid
+
+    # Probe with plain strings; only the returned name becomes a Path.
+    md = os.fspath(month_dir)
+    taken_paths = reserved or frozenset()
+
+    def exists(path: str) -> bool:
+        return path in taken_paths or os.path.exists(path)
 
-    candidate = month_dir / f"{base_noext}.zip"
-    if not candidate.exists():
-        return candidate
+    first = os.path.join(md, f"{base_noext}.zip")
+    if not exists(first):
+        return Path(first)
 
-    # Avoid collisions if a similarly named study already exists.
+    # Avoid collisions if a similarly named study already exists: one listing
+    # finds the first free suffix instead of a stat() per taken one.
+    try:
+        taken = set(os.listdir(md))
+    except OSError:
+        taken = set()
     n = 2
     while True:
-        cand = month_dir / f"{base_noext}_{n}.zip"
-        if not cand.exists():
-            return cand
+        name = f"{base_noext}_{n}.zip"
+        if name not in taken:
+            cand = os.path.join(md, name)
+            # Re-check on disk in case the folder changed since the listing.
+            if not exists(cand):
+                return Path(cand)
         n += 1
 
 
@@ -24,12 +24,70 @@ QUERY_IMAGE_PATHS_BY_STUDY_PK = """
 """
 
 
-def build_studies_query(config: BackupConfig) -> str:
-    mods_placeholders = ",".join("?" * len(config.settings.mods))
+# Older SQLite builds cap bound parameters at 999; stay well below it.
+MAX_SQL_PARAMS = 500
+
+
+def build_image_paths_query(n_studies: int) -> str:
+    # Fetch image paths for a whole batch at once; rows are bucketed by studyPK.
+    pk_placeholders = ",".join("?" * n_studies)
+    return f"""
+        SELECT DISTINCT
+            s.ZSTUDY AS studyPK,
+            i.ZPATHSTRING,
+            i.ZPATHNUMBER,
+            i.ZSTOREDINDATABASEFOLDER
+        FROM ZSERIES s
+        JOIN ZIMAGE  i ON i.ZSERIES = s.Z_PK
+        WHERE s.ZSTUDY IN ({pk_placeholders})
+          AND i.ZPATHSTRING IS NOT NULL
+          AND i.ZPATHSTRING <> '';
+    """
+
+
+def _sql_literal_list(values) -> str:
+    # Inline constant values as quoted SQL literals (single quotes doubled).
+    return ",".join("'" + str(v).replace("'", "''") + "'" for v in values)
+
+
+def build_candidates_table_sql(config: BackupConfig) -> str:
+    # Materialize the (study, modality) pairs of interest once per run with a
+    # single ZSERIES scan; the stats and the batch query both read from it.
+    # MODS is fixed for the run, so it is inlined as a constant IN list
+    # rather than bound as parameters.
+    mods_literal = _sql_literal_list(config.settings.mods)
+    return f"""
+        CREATE TEMP TABLE Candidates AS
+        SELECT DISTINCT
+            s.ZSTUDY                                AS studyPK,
+            TRIM(UPPER(COALESCE(s.ZMODALITY,'')))  AS modality
+        FROM ZSERIES s
+        WHERE TRIM(UPPER(COALESCE(s.ZMODALITY,''))) IN ({mods_literal});
+    """
+
+
+CREATE_CANDIDATES_INDEX = "CREATE INDEX temp.ix_candidates_pk ON Candidates(studyPK);"
+
 
-    query_by_studydate = f"""
+# One pass over temp.Candidates: LEFT JOINs keep every candidate (even one
+# without a ZSTUDY row) while the exported count reads the same joined rows.
+QUERY_CANDIDATE_STATS = """
+    SELECT
+        COUNT(DISTINCT c.studyPK)                                                      AS total_candidates,
+        COUNT(DISTINCT CASE WHEN c.modality = 'CT' THEN c.studyPK END)               AS series_ct,
+        COUNT(DISTINCT CASE WHEN c.modality = 'MR' THEN c.studyPK END)               AS series_mr,
+        COUNT(DISTINCT CASE WHEN ex.studyInstanceUID IS NOT NULL THEN c.studyPK END) AS exported_in_candidates
+    FROM temp.Candidates c
+    LEFT JOIN ZSTUDY st          ON st.Z_PK = c.studyPK
+    LEFT JOIN state.Exported ex  ON ex.studyInstanceUID = st.ZSTUDYINSTANCEUID;
+"""
+
+
+def build_studies_query(config: BackupConfig) -> str:
+    # Both variants expect temp.Candidates (see build_candidates_table_sql).
+    query_by_studydate = """
         WITH CandidateStudies AS (
-          -- Build a set of studies that have at least one CT/MR series.
+          -- Studies that have at least one series in the configured modalities.
           SELECT
             st.Z_PK                   AS studyPK,
             st.ZSTUDYINSTANCEUID      AS studyUID,
@@ -37,23 +95,18 @@ def build_studies_query(config: BackupConfig) -> str:
             COALESCE(st.ZDATEOFBIRTH,'') AS dob,
             COALESCE(st.ZNAME,'')     AS patientName
           FROM ZSTUDY st
-          WHERE EXISTS (
-            SELECT 1
-            FROM ZSERIES s
-            WHERE s.ZSTUDY = st.Z_PK
-              AND TRIM(UPPER(COALESCE(s.ZMODALITY,''))) IN ({mods_placeholders})
-          )
+          WHERE st.Z_PK IN (SELECT studyPK FROM temp.Candidates)
         )
         SELECT cs.*
         FROM CandidateStudies cs
-        LEFT JOIN state.Exported ex ON ex.studyInstanceUID = cs.studyUID
-        WHERE ex.studyInstanceUID IS NULL
+        -- Anti-join probing Exported's primary-key index.
+        WHERE NOT EXISTS (SELECT 1 FROM state.Exported ex WHERE ex.studyInstanceUID = cs.studyUID)
         -- Order deterministically so repeated runs pick up the same studies.
         ORDER BY cs.studyDate ASC, cs.studyUID ASC
         LIMIT ?;
     """
 
-    query_by_dateadded = f"""
+    query_by_dateadded = """
         WITH CandidateStudies AS (
           -- Alternative ordering: process newest imports first.
           SELECT
@@ -64,17 +117,12 @@ def build_studies_query(config: BackupConfig) -> str:
             COALESCE(st.ZDATEOFBIRTH,'') AS dob,
             COALESCE(st.ZNAME,'')        AS patientName
           FROM ZSTUDY st
-          WHERE EXISTS (
-            SELECT 1
-            FROM ZSERIES s
-            WHERE s.ZSTUDY = st.Z_PK
-              AND TRIM(UPPER(COALESCE(s.ZMODALITY,''))) IN ({mods_placeholders})
-          )
+          WHERE st.Z_PK IN (SELECT studyPK FROM temp.Candidates)
         )
         SELECT cs.*
         FROM CandidateStudies cs
-        LEFT JOIN state.Exported ex ON ex.studyInstanceUID = cs.studyUID
-        WHERE ex.studyInstanceUID IS NULL
+        -- Anti-join probing Exported's primary-key index.
+        WHERE NOT EXISTS (SELECT 1 FROM state.Exported ex WHERE ex.studyInstanceUID = cs.studyUID)
         ORDER BY cs.dateAdded ASC, cs.studyUID ASC
         LIMIT ?;
     """
@@ -82,4 +130,12 @@ def build_studies_query(config: BackupConfig) -> str:
     return query_by_dateadded if config.settings.order_by == "date_added" else query_by_studydate
 
 
-__all__ = ["QUERY_IMAGE_PATHS_BY_STUDY_PK", "build_studies_query"]
+__all__ = [
+    "QUERY_IMAGE_PATHS_BY_STUDY_PK",
+    "QUERY_CANDIDATE_STATS",
+    "CREATE_CANDIDATES_INDEX",
+    "MAX_SQL_PARAMS",
+    "build_image_paths_query",
+    "build_candidates_table_sql",
+    "build_studies_query",
+]
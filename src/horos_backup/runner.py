@@ -13,13 +13,16 @@ import logging
 import os
 import sqlite3
 import time
+from collections import defaultdict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Dict, Optional
+from typing import Dict, List, Optional, Set, Tuple
 
-from .config import BackupConfig, DEFAULT_CONFIG
+from .config import BackupConfig, DEFAULT_CONFIG, Settings
 from .dates import debug_dump_date, month_dir_for
-from .db_snapshot import choose_db_path
+from .db_snapshot import choose_db_path, ensure_snapshot_indexes
 from .fs_utils import (
+    clear_listdir_cache,
     count_files_early,
     dump_fs_layout,
     ensure_dirs,
@@ -27,14 +30,124 @@ from .fs_utils import (
     mark_month_done,
     reset_incomplete_latest_month,
     resolve_image_path,
+    resolve_image_path_str,
 )
-from .issues import issues_log
+from .issues import ISSUES_FLUSH_TIMEOUT, flush_issues, issues_log
 from .locks import acquire_lock, release_lock
 from .logging_setup import setup_logging
 from .naming import build_zip_path
-from .queries import QUERY_IMAGE_PATHS_BY_STUDY_PK, build_studies_query
-from .state import mark_exported, state_connect
-from .zip_utils import verify_zip, zip_study_atomic
+from .queries import (
+    CREATE_CANDIDATES_INDEX,
+    MAX_SQL_PARAMS,
+    QUERY_CANDIDATE_STATS,
+    build_candidates_table_sql,
+    build_image_paths_query,
+    build_studies_query,
+)
+from .state import mark_exported_many, state_connect
+from .zip_utils import MAX_ZIP_WORKERS, pick_compression, verify_zip, zip_study_atomic
+
+
+def _checked_paths_sample(rows_img, config: BackupConfig, limit: int = 5) -> List[tuple]:
+    """
+    Rebuild the ``(path, exists)`` sample recorded for NO_FILES issues.
+
+    Only computed once a study turned out to have no files, so the extra
+    stat calls stay off the common path.
+    """
+    checked: List[tuple] = []
+    for r in rows_img:
+        if len(checked) >= limit:
+            break
+        zpathstring = r["ZPATHSTRING"]
+        zpathnumber = r["ZPATHNUMBER"]
+        zstored_in = r["ZSTOREDINDATABASEFOLDER"]
+        try:
+            in_db_flag = int(zstored_in) == 1
+        except Exception:
+            in_db_flag = False
+        p, exists = resolve_image_path(zpathstring, zpathnumber, zstored_in, config)
+        if in_db_flag:
+            s_local = str(zpathstring or "").lstrip("/")
+            sub_local = (str(zpathnumber).strip() if zpathnumber is not None else "")
+            cand1 = (config.paths.database_dir / sub_local / s_local) if sub_local else (config.paths.database_dir / s_local)
+            cand2 = (config.paths.database_dir / s_local)
+            for cand in (cand1, cand2) if str(cand2) != str(cand1) else (cand1,):
+                if len(checked) >= limit:
+                    break
+                # resolve_image_path probes cand1 first: on a miss every candidate
+                # is known absent, and cand1 is absent whenever it did not win.
+                if cand == p:
+                    known = exists
+                elif not exists or cand == cand1:
+                    known = False
+                else:
+                    known = cand.is_file()
+                checked.append((str(cand), known))
+        else:
+            checked.append((str(p), exists))
+    return checked
+
+
+def _system_busy(settings: Settings) -> bool:
+    # 1-minute load average above the configured share of the cores.
+    try:
+        load1 = os.getloadavg()[0]
+    except (AttributeError, OSError):
+        return False
+    return load1 > (os.cpu_count() or 1) * settings.load_throttle_factor
+
+
+def _export_study(
+    study_uid: str,
+    files: List[str],
+    out_zip: Path,
+    log: logging.Logger,
+    zip_workers: int,
+    settings: Settings,
+) -> Tuple[bool, int]:
+    """
+    Zip and verify one study, retrying up to 3 times; returns ``(ok, attempts)``.
+
+    Verification is the light layout check unless ``settings.deep_verify``
+    is set; the last attempt always runs a full ``testzip()``. Runs on a
+    study worker thread and never touches the state DB: the caller records
+    the outcome on the main thread.
+    """
+    # Back off briefly, only when the machine is already saturated.
+    if settings.load_throttle_sleep > 0 and _system_busy(settings):
+        time.sleep(settings.load_throttle_sleep)
+    ok = False
+    attempts = 0
+    # Deflate only native pixel data; JPEG/J2K/RLE studies are stored as-is.
+    compression, compresslevel = pick_compression(files, settings.deflate_level)
+    # Retry ZIP creation up to 3 times to dodge transient I/O issues.
+    while attempts < 3 and not ok:
+        attempts += 1
+        try:
+            log.info("Exporting study %s (attempt %d)", study_uid, attempts)
+            zip_study_atomic(
+                files, out_zip, compression=compression, compresslevel=compresslevel, workers=zip_workers
+            )
+            if verify_zip(out_zip, logger=log, deep=settings.deep_verify or attempts == 3):
+                try:
+                    zip_size = os.stat(out_zip).st_size
+                except Exception:
+                    zip_size = -1
+                log.info("OK: study %s (files=%d, size=%d bytes)", study_uid, len(files), zip_size)
+                ok = True
+            else:
+                out_zip.unlink(missing_ok=True)
+                time.sleep(1)
+        except Exception:
+            log.exception("Failed to export %s", study_uid)
+            try:
+                if out_zip.exists():
+                    out_zip.unlink()
+            except Exception:
+                pass
+            time.sleep(1)
+    return ok, attempts
 
 
 def run_once(config: BackupConfig = DEFAULT_CONFIG, logger: Optional[logging.Logger] = None):
@@ -72,9 +185,25 @@ def run_once(config: BackupConfig = DEFAULT_CONFIG, logger: Optional[logging.Log
             raise
 
         try:
-            # Open the snapshot in query-only mode to match macOS Horos DB.
-            conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+            # One connection for the index build and all queries, so the pages
+            # ANALYZE pulled in stay cached. The snapshot is our own disposable
+            # copy; query_only keeps it read-only once the indexes exist.
+            conn = sqlite3.connect(db_path)
             conn.row_factory = sqlite3.Row
+            try:
+                # Keep the candidates temp table and sort spills in RAM.
+                conn.execute("PRAGMA temp_store=MEMORY;")
+                conn.execute("PRAGMA cache_size=-65536;")
+                # Read snapshot pages through a 256 MB mapping instead of read() calls.
+                conn.execute("PRAGMA mmap_size=268435456;")
+                # Nothing else opens the snapshot during a run, so keep its file
+                # lock for the whole connection instead of re-taking it per
+                # statement. Scoped to main: the ATTACHed state DB must stay
+                # writable from state_conn.
+                conn.execute("PRAGMA main.locking_mode=EXCLUSIVE;")
+            except Exception:
+                pass
+            ensure_snapshot_indexes(db_path, logger=log, conn=conn)
             try:
                 conn.execute("PRAGMA query_only=ON;")
             except Exception:
@@ -89,29 +218,21 @@ def run_once(config: BackupConfig = DEFAULT_CONFIG, logger: Optional[logging.Log
         try:
             # State DB records exported studies so we never duplicate work.
             state_conn = state_connect(config)
-            cur.execute("ATTACH DATABASE ? AS state", (f"file:{config.paths.state_db}?mode=ro",))
+            # Attach read-write so the reader can share the state DB's WAL/shm files.
+            cur.execute("ATTACH DATABASE ? AS state", (str(config.paths.state_db),))
+
+            # Single ZSERIES scan shared by the stats and the batch selection.
+            # query_only blocks TEMP writes too, so lift it just for this step.
+            conn.execute("PRAGMA query_only=OFF;")
+            try:
+                cur.execute(build_candidates_table_sql(config))
+                cur.execute(CREATE_CANDIDATES_INDEX)
+            finally:
+                conn.execute("PRAGMA query_only=ON;")
 
             try:
                 # Quick stats: how many studies are eligible and already exported.
-                cur.execute(
-                    """
-                    WITH cs AS (
-                        SELECT DISTINCT s.ZSTUDY AS ZSTUDY
-                        FROM ZSERIES s
-                        WHERE TRIM(UPPER(COALESCE(s.ZMODALITY,''))) IN ('CT','MR')
-                    )
-                    SELECT
-                        (SELECT COUNT(*) FROM cs) AS total_candidates,
-                        (SELECT COUNT(DISTINCT s.ZSTUDY) FROM ZSERIES s WHERE TRIM(UPPER(COALESCE(s.ZMODALITY,'')))='CT') AS series_ct,
-                        (SELECT COUNT(DISTINCT s.ZSTUDY) FROM ZSERIES s WHERE TRIM(UPPER(COALESCE(s.ZMODALITY,'')))='MR') AS series_mr,
-                        (
-                        SELECT COUNT(*)
-                        FROM cs
-                        JOIN ZSTUDY st ON st.Z_PK = cs.ZSTUDY
-                        JOIN state.Exported ex ON ex.studyInstanceUID = st.ZSTUDYINSTANCEUID
-                        ) AS exported_in_candidates
-                """
-                )
+                cur.execute(QUERY_CANDIDATE_STATS)
                 row = cur.fetchone()
                 total_candidates = int(row["total_candidates"])
                 series_ct = int(row["series_ct"])
@@ -135,8 +256,10 @@ def run_once(config: BackupConfig = DEFAULT_CONFIG, logger: Optional[logging.Log
                 log.exception("Failed to calculate candidate/exported snapshot")
 
             studies_query = build_studies_query(config)
-            cur.execute(studies_query, (*config.settings.mods, config.settings.batch_size))
-            studies = cur.fetchall()
+            cur.execute(studies_query, (config.settings.batch_size,))
+            # Plain namedtuples: attribute access without sqlite3.Row key lookups in the loop.
+            Study = namedtuple("Study", [d[0] for d in cur.description])
+            studies = [Study(*r) for r in cur.fetchall()]
 
             log.info(
                 "Studies selected for the batch: %d (ORDER_BY=%s, MODS=%s, BATCH_SIZE=%d)",
@@ -146,133 +269,129 @@ def run_once(config: BackupConfig = DEFAULT_CONFIG, logger: Optional[logging.Log
                 config.settings.batch_size,
             )
             for i, r in enumerate(studies[:3]):
-                keys = r.keys()
-                zdate = r["studyDate"] if "studyDate" in keys else (r["dateAdded"] if "dateAdded" in keys else "")
-                dob = r["dob"] if "dob" in keys else ""
-                pname = r["patientName"] if "patientName" in keys else ""
                 log.debug(
                     "Study[%d] PK=%s UID=%s DATE=%r DOB=%r NAME=%r",
                     i,
-                    r["studyPK"],
-                    r["studyUID"],
-                    zdate,
-                    dob,
-                    pname,
+                    r.studyPK,
+                    r.studyUID,
+                    r.studyDate,
+                    r.dob,
+                    r.patientName,
                 )
 
             if not studies:
                 log.info("Nothing to export in this cycle.")
                 return
 
-            zips_by_month: Dict[Path, int] = {}
+            # Fetch image paths for the whole batch in one query (per 500 PKs) instead of one per study.
+            images_by_pk: Dict[int, List[sqlite3.Row]] = defaultdict(list)
+            study_pks = [r.studyPK for r in studies]
+            for start in range(0, len(study_pks), MAX_SQL_PARAMS):
+                chunk = study_pks[start : start + MAX_SQL_PARAMS]
+                # Bucket rows straight off the cursor; no intermediate fetchall() list.
+                for r in cur.execute(build_image_paths_query(len(chunk)), chunk):
+                    images_by_pk[r["studyPK"]].append(r)
 
-            for row in studies:
-                study_pk = row["studyPK"]
-                study_uid = row["studyUID"]
-                rk = row.keys()
-                # Fall back to dateAdded when the configured ordering requires it.
-                study_ts = row["studyDate"] if "studyDate" in rk else (row["dateAdded"] if "dateAdded" in rk else "")
-                dob_ts = row["dob"]
-                patient_nm = row["patientName"]
-
-                debug_dump_date("study_date", study_ts, logger=log)
-                debug_dump_date("dob", dob_ts, logger=log)
-
-                month_dir = month_dir_for(study_ts, config)
-                log.debug("month_dir=%s", month_dir)
-
-                out_zip = build_zip_path(month_dir, patient_nm, dob_ts, study_ts, study_uid, config)
-                log.debug("Destination ZIP prepared for study %s", study_uid)
-
-                cur2 = conn.cursor()
-                # Fetch all image paths for the current study.
-                cur2.execute(QUERY_IMAGE_PATHS_BY_STUDY_PK, (study_pk,))
-                rows_img = cur2.fetchall()
-
-                files = []
-                debug_checked = []
-
-                for r in rows_img:
-                    zpathstring = r["ZPATHSTRING"]
-                    zpathnumber = r["ZPATHNUMBER"]
-                    zstored_in = r["ZSTOREDINDATABASEFOLDER"]
-
-                    # Resolve possible locations following Horos conventions.
-                    p = resolve_image_path(zpathstring, zpathnumber, zstored_in, config)
-                    exists = p.is_file()
-                    if exists:
-                        files.append(p)
-
-                    if len(debug_checked) < 5:
-                        log.debug(
-                            "IMG CAND: ZPATHSTRING=%r ZPATHNUMBER=%r ZINDB=%r -> resolved=%s exists=%s",
-                            zpathstring,
-                            zpathnumber,
-                            zstored_in,
-                            p,
-                            exists,
+            zips_by_month: Dict[Path, int] = {}
+            jobs: List[Tuple[str, List[str], Path, Path]] = []
+            # ZIP names handed out in this batch: they only exist on disk once
+            # their worker finishes, so build_zip_path must skip them itself.
+            reserved_zips: Set[str] = set()
+            exported_rows: List[Tuple[str, Path]] = []
+            # Directory listings are cached per batch; start from a clean slate.
+            clear_listdir_cache()
+
+            # Zip several studies at once: reads, CRCs and writes overlap across
+            # studies (and with resolving the next ones), while every
+            # state/issues write stays on this thread.
+            study_workers = max(1, min(config.settings.zip_study_workers, len(studies)))
+            zip_workers = max(1, min(MAX_ZIP_WORKERS, (os.cpu_count() or 1) // study_workers))
+            futures = []
+            # Per-study and per-image diagnostics only when DEBUG records are actually emitted.
+            debug = log.isEnabledFor(logging.DEBUG)
+            with ThreadPoolExecutor(max_workers=study_workers, thread_name_prefix="study-zip") as pool:
+                for row in studies:
+                    study_pk = row.studyPK
+                    study_uid = row.studyUID
+                    # Both orderings select studyDate; dateAdded only drives the sort.
+                    study_ts = row.studyDate
+                    dob_ts = row.dob
+                    patient_nm = row.patientName
+
+                    if debug:
+                        debug_dump_date("study_date", study_ts, logger=log)
+                        debug_dump_date("dob", dob_ts, logger=log)
+
+                    month_dir = month_dir_for(study_ts, config)
+                    out_zip = build_zip_path(
+                        month_dir, patient_nm, dob_ts, study_ts, study_uid, config, reserved=reserved_zips
+                    )
+                    if debug:
+                        log.debug("month_dir=%s", month_dir)
+                        log.debug("Destination ZIP prepared for study %s", study_uid)
+
+                    rows_img = images_by_pk.get(study_pk, [])
+
+                    files = []
+                    if not debug:
+                        # Hot path: no per-image bookkeeping, just resolve and keep hits.
+                        for r in rows_img:
+                            p, exists = resolve_image_path_str(
+                                r["ZPATHSTRING"], r["ZPATHNUMBER"], r["ZSTOREDINDATABASEFOLDER"], config
+                            )
+                            if exists:
+                                files.append(p)
+                    else:
+                        for idx, r in enumerate(rows_img):
+                            zpathstring = r["ZPATHSTRING"]
+                            zpathnumber = r["ZPATHNUMBER"]
+                            zstored_in = r["ZSTOREDINDATABASEFOLDER"]
+
+                            # Resolve possible locations following Horos conventions.
+                            p, exists = resolve_image_path_str(zpathstring, zpathnumber, zstored_in, config)
+                            if exists:
+                                files.append(p)
+
+                            if idx < 5:
+                                log.debug(
+                                    "IMG CAND: ZPATHSTRING=%r ZPATHNUMBER=%r ZINDB=%r -> resolved=%s exists=%s",
+                                    zpathstring,
+                                    zpathnumber,
+                                    zstored_in,
+                                    p,
+                                    exists,
+                                )
+
+                    if debug:
+                        log.debug("ZIMAGE rows for study_pk=%s: %d; found=%d", study_pk, len(rows_img), len(files))
+
+                    if not files:
+                        # Record missing data instead of failing the entire batch.
+                        log.warning("Study %s: no files found. Marking as NO_FILES.", study_uid)
+                        debug_checked = _checked_paths_sample(rows_img, config)
+                        issues_log(
+                            config,
+                            "NO_FILES",
+                            study_uid,
+                            "No valid files found",
+                            {"study_pk": int(study_pk), "checked": debug_checked},
                         )
-                        try:
-                            in_db_flag = int(zstored_in) == 1
-                        except Exception:
-                            in_db_flag = False
-                        if in_db_flag:
-                            s_local = str(zpathstring or "").lstrip("/")
-                            sub_local = (str(zpathnumber).strip() if zpathnumber is not None else "")
-                            cand1 = (config.paths.database_dir / sub_local / s_local) if sub_local else (config.paths.database_dir / s_local)
-                            cand2 = (config.paths.database_dir / s_local)
-                            debug_checked.append((str(cand1), cand1.is_file()))
-                            if str(cand2) != str(cand1) and len(debug_checked) < 5:
-                                debug_checked.append((str(cand2), cand2.is_file()))
-                        else:
-                            debug_checked.append((str(p), exists))
-
-                log.debug("ZIMAGE rows for study_pk=%s: %d; found=%d", study_pk, len(rows_img), len(files))
-
-                if not files:
-                    # Record missing data instead of failing the entire batch.
-                    log.warning("Study %s: no files found. Marking as NO_FILES.", study_uid)
-                    issues_log(
-                        config,
-                        "NO_FILES",
-                        study_uid,
-                        "No valid files found",
-                        {"study_pk": int(study_pk), "checked": debug_checked},
+                        log.debug("Paths checked (sample): %s", debug_checked)
+                        continue
+
+                    reserved_zips.add(str(out_zip))
+                    jobs.append((study_uid, files, out_zip, month_dir))
+                    # Start zipping now, while later studies are still being resolved.
+                    futures.append(
+                        pool.submit(_export_study, study_uid, files, out_zip, log, zip_workers, config.settings)
                     )
-                    log.debug("Paths checked (sample): %s", debug_checked)
-                    continue
-
-                ok = False
-                attempts = 0
-                # Retry ZIP creation up to 3 times to dodge transient I/O issues.
-                while attempts < 3 and not ok:
-                    attempts += 1
-                    try:
-                        log.info("Exporting study %s (attempt %d)", study_uid, attempts)
-                        zip_study_atomic(files, out_zip)
-                        if verify_zip(out_zip, logger=log):
-                            try:
-                                zip_size = os.stat(out_zip).st_size
-                            except Exception:
-                                zip_size = -1
-                            log.info("OK: study %s (files=%d, size=%d bytes)", study_uid, len(files), zip_size)
-                            # Persist export metadata so future runs skip this study.
-                            mark_exported(state_conn, study_uid, out_zip)
-                            zips_by_month[month_dir] = zips_by_month.get(month_dir, 0) + 1
-                            ok = True
-                        else:
-                            out_zip.unlink(missing_ok=True)
-                            time.sleep(1)
-                    except Exception:
-                        log.exception("Failed to export %s", study_uid)
-                        try:
-                            if out_zip.exists():
-                                out_zip.unlink()
-                        except Exception:
-                            pass
-                        time.sleep(1)
-
-                if not ok:
+
+                for (study_uid, files, out_zip, month_dir), fut in zip(jobs, futures):
+                    ok, attempts = fut.result()
+                    if ok:
+                        exported_rows.append((study_uid, out_zip))
+                        zips_by_month[month_dir] = zips_by_month.get(month_dir, 0) + 1
+                        continue
                     log.error("Study %s: failed after %d attempts. Recording in issues.csv.", study_uid, attempts)
                     issues_log(
                         config,
@@ -282,23 +401,47 @@ def run_once(config: BackupConfig = DEFAULT_CONFIG, logger: Optional[logging.Log
                         {"zip_path": str(out_zip), "files": len(files)},
                     )
 
-                time.sleep(config.settings.sleep_between_studies)
+            # Persist export metadata so future runs skip these studies: one
+            # short write transaction, one prepared insert, one commit.
+            if exported_rows:
+                state_conn.execute("BEGIN IMMEDIATE")
+                mark_exported_many(state_conn, exported_rows)
+                state_conn.commit()
 
             for month_dir, cnt in zips_by_month.items():
                 if cnt > 0:
                     # Mark months that received any ZIPs as complete for resilience.
                     mark_month_done(month_dir, logger=log)
+
+            # Give Horos some I/O headroom, but only while it is busy importing.
+            if (
+                config.settings.sleep_between_studies > 0
+                and incoming_count > config.settings.incoming_throttle_files
+            ):
+                time.sleep(config.settings.sleep_between_studies)
         finally:
+            clear_listdir_cache()
             try:
                 conn.close()
             except Exception:
                 pass
             if state_conn is not None:
+                try:
+                    # Discard uncommitted batch rows if the loop aborted.
+                    state_conn.rollback()
+                except Exception:
+                    pass
                 try:
                     state_conn.close()
                 except Exception:
                     pass
     finally:
+        # Queued issue rows must be in issues.csv before the next run can start,
+        # but a stuck writer must not keep the run lock forever.
+        if not flush_issues(timeout=ISSUES_FLUSH_TIMEOUT):
+            log.warning(
+                "issues.csv writer did not flush within %.0f s; releasing the lock anyway.", ISSUES_FLUSH_TIMEOUT
+            )
         release_lock(lock_fh)
 
 
@@ -14,9 +14,24 @@ import sqlite3
 from .config import BackupConfig
 
 
+# One literal for every upsert, so sqlite3's per-connection statement cache
+# hands back the already compiled statement instead of re-preparing it.
+_INSERT_EXPORTED = (
+    "INSERT OR REPLACE INTO Exported (studyInstanceUID, when_exported, zip_path) VALUES (?, datetime('now'), ?);"
+)
+
+
 def state_connect(config: BackupConfig):
     # A tiny SQLite DB persisted alongside backups to track exported studies.
     conn = sqlite3.connect(str(config.paths.state_db))
+    # WAL keeps the ATTACHed reader in run_once from blocking our writes, and
+    # synchronous=NORMAL turns each commit into one appended WAL frame instead
+    # of a rollback-journal fsync round trip on the external disk.
+    conn.execute("PRAGMA journal_mode=WAL;")
+    conn.execute("PRAGMA synchronous=NORMAL;")
+    conn.execute("PRAGMA temp_store=MEMORY;")
+    conn.execute("PRAGMA cache_size=-20000;")
+    conn.execute("PRAGMA busy_timeout=5000;")
     cur = conn.cursor()
     cur.execute(
         """
@@ -27,18 +42,42 @@ def state_connect(config: BackupConfig):
         );
         """
     )
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS SnapshotMeta (
+            id        INTEGER PRIMARY KEY CHECK (id = 1),
+            signature TEXT NOT NULL
+        );
+        """
+    )
     conn.commit()
     return conn
 
 
-def mark_exported(state_conn, study_uid: str, zip_path):
+def mark_exported(state_conn, study_uid: str, zip_path, commit: bool = True):
     # Idempotent insert so repeated runs simply overwrite with the latest path.
-    cur = state_conn.cursor()
-    cur.execute(
-        "INSERT OR REPLACE INTO Exported (studyInstanceUID, when_exported, zip_path) VALUES (?, datetime('now'), ?);",
-        (study_uid, str(zip_path)),
-    )
+    # Commits by default; pass commit=False when the caller owns a batch
+    # transaction and commits once at the end.
+    state_conn.execute(_INSERT_EXPORTED, (study_uid, str(zip_path)))
+    if commit:
+        state_conn.commit()
+
+
+def mark_exported_many(state_conn, rows):
+    # Same upsert as mark_exported for a batch of (study_uid, zip_path) pairs,
+    # with one prepared statement. The caller owns the transaction.
+    state_conn.executemany(_INSERT_EXPORTED, [(uid, str(zip_path)) for uid, zip_path in rows])
+
+
+def get_snapshot_signature(state_conn):
+    # Signature of the Horos DB the current snapshot was copied from, if any.
+    row = state_conn.execute("SELECT signature FROM SnapshotMeta WHERE id = 1;").fetchone()
+    return row[0] if row else None
+
+
+def set_snapshot_signature(state_conn, signature: str):
+    state_conn.execute("INSERT OR REPLACE INTO SnapshotMeta (id, signature) VALUES (1, ?);", (signature,))
     state_conn.commit()
 
 
-__all__ = ["state_connect", "mark_exported"]
+__all__ = ["state_connect", "mark_exported", "mark_exported_many", "get_snapshot_signature", "set_snapshot_signature"]
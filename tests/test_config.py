@@ -0,0 +1,35 @@
+#
+# test_config.py
+# Horos Backup Script
+#
+# Checks that settings are validated when the configuration is built.
+#
+# Thales Matheus Mendonça Santos - November 2025
+#
+import logging
+
+import pytest
+
+from horos_backup.config import Settings
+
+
+def test_deflate_level_defaults_to_one():
+    assert Settings().deflate_level == 1
+
+
+def test_deflate_level_is_lowered_to_backend_maximum(monkeypatch, caplog):
+    import horos_backup.zip_utils as zu
+
+    # As with the ISA-L backend, which stops at level 3.
+    monkeypatch.setattr(zu, "MAX_DEFLATE_LEVEL", 3)
+    with caplog.at_level(logging.WARNING, logger="horos_backup"):
+        settings = Settings(deflate_level=6)
+    assert settings.deflate_level == 3
+    assert "deflate_level 6 is not supported" in caplog.text
+    assert Settings(deflate_level=2).deflate_level == 2
+
+
+@pytest.mark.parametrize("level", [-1, 10])
+def test_deflate_level_outside_zlib_range_is_rejected(level):
+    with pytest.raises(ValueError):
+        Settings(deflate_level=level)
@@ -27,3 +27,27 @@ def test_fmt_date_for_name_and_month_dir(tmp_path, temp_config):
     month_dir = month_dir_for("2023-02-03", temp_config)
     assert month_dir.name == "2023_02"
     assert month_dir.parent == temp_config.paths.backup_root
+
+
+def test_parse_timestamp_numeric_strings_and_memoization():
+    # Numeric strings are still CoreData seconds, even when they look like YYYYMMDD.
+    assert parse_timestamp_to_parts("86400") == ("2001", "01", "02")
+    assert parse_timestamp_to_parts("-86400") == ("2000", "12", "31")
+    # Text that cannot be a number skips float() entirely and reaches the regexes.
+    assert parse_timestamp_to_parts("Study 2022-11-05") == ("2022", "11", "05")
+    assert parse_timestamp_to_parts("unknown") == (None, None, None)
+    # Repeated inputs are answered from the cache.
+    parse_timestamp_to_parts.cache_clear()
+    parse_timestamp_to_parts("2023-02-03")
+    parse_timestamp_to_parts("2023-02-03")
+    assert parse_timestamp_to_parts.cache_info().hits == 1
+
+
+def test_parse_timestamp_native_numbers_and_date_prefix():
+    # Floats/ints from SQLite match their string form.
+    assert parse_timestamp_to_parts(600000000.0) == parse_timestamp_to_parts("600000000.0") == ("2020", "01", "06")
+    assert parse_timestamp_to_parts(86400) == ("2001", "01", "02")
+    assert parse_timestamp_to_parts(float("nan")) == (None, None, None)
+    # Leading ISO dates take the fixed-position path; others still use the regexes.
+    assert parse_timestamp_to_parts("2021/03/04 10:00") == ("2021", "03", "04")
+    assert parse_timestamp_to_parts("2021-3-04") == (None, None, None)
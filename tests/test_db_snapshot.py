@@ -13,7 +13,7 @@ import sqlite3
 import pytest
 
 from horos_backup.config import BackupConfig, Paths, Settings
-from horos_backup.db_snapshot import choose_db_path, copy_horos_db_consistent
+from horos_backup.db_snapshot import choose_db_path, copy_horos_db_consistent, ensure_snapshot_indexes
 
 
 # ---------------------------------------------------------------------------
@@ -66,6 +66,15 @@ class TestCopyHorosDbConsistent:
         conn.execute("SELECT name FROM sqlite_master")
         conn.close()
 
+    def test_reports_progress_when_callback_given(self, temp_config):
+        _make_db(temp_config.paths.horos_db_orig)
+        calls = []
+
+        copy_horos_db_consistent(temp_config, progress=lambda status, remaining, total: calls.append(remaining))
+
+        # The whole (tiny) DB fits in one batched step.
+        assert calls and calls[-1] == 0
+
     def test_returns_string_path(self, temp_config):
         _make_db(temp_config.paths.horos_db_orig)
         result = copy_horos_db_consistent(temp_config)
@@ -161,8 +170,90 @@ class TestChooseDbPath:
 
         assert "creating a copy now (one-shot)" in caplog.text
 
+    def test_use_db_copy_true_reuses_snapshot_when_source_unchanged(self, temp_config, caplog):
+        _make_db(temp_config.paths.horos_db_orig)
+        choose_db_path(temp_config)
+        first_mtime = temp_config.paths.dbcopy_path.stat().st_mtime_ns
+
+        with caplog.at_level(logging.INFO, logger="horos_backup"):
+            choose_db_path(temp_config)
+
+        assert "Horos DB unchanged" in caplog.text
+        assert temp_config.paths.dbcopy_path.stat().st_mtime_ns == first_mtime
+
+    def test_use_db_copy_true_recopies_after_source_changes(self, temp_config):
+        _make_db(temp_config.paths.horos_db_orig)
+        choose_db_path(temp_config)
+
+        conn = sqlite3.connect(str(temp_config.paths.horos_db_orig))
+        conn.execute("CREATE TABLE added_later (id INTEGER)")
+        conn.commit()
+        conn.close()
+
+        choose_db_path(temp_config)
+
+        conn = sqlite3.connect(str(temp_config.paths.dbcopy_path))
+        names = {r[0] for r in conn.execute("SELECT name FROM sqlite_master")}
+        conn.close()
+        assert "added_later" in names
+
     def test_use_db_copy_true_raises_when_source_missing(self, temp_config):
         # Source DB absent — must propagate FileNotFoundError even in use_db_copy mode.
         assert temp_config.settings.use_db_copy is True
         with pytest.raises(FileNotFoundError):
-            choose_db_path(temp_config)
\ No newline at end of file
+            choose_db_path(temp_config)
+
+# ---------------------------------------------------------------------------
+# ensure_snapshot_indexes
+# ---------------------------------------------------------------------------
+
+class TestEnsureSnapshotIndexes:
+    def test_creates_indexes_on_horos_tables(self, tmp_path):
+        db = tmp_path / "snap.sql"
+        conn = sqlite3.connect(str(db))
+        conn.execute("CREATE TABLE ZSERIES (Z_PK INTEGER PRIMARY KEY, ZSTUDY INTEGER, ZMODALITY TEXT)")
+        conn.execute("CREATE TABLE ZIMAGE (Z_PK INTEGER PRIMARY KEY, ZSERIES INTEGER)")
+        conn.execute(
+            "CREATE TABLE ZSTUDY (Z_PK INTEGER PRIMARY KEY, ZDATE REAL, ZDATEADDED REAL, ZSTUDYINSTANCEUID TEXT)"
+        )
+        conn.commit()
+        conn.close()
+
+        ensure_snapshot_indexes(str(db))
+
+        conn = sqlite3.connect(str(db))
+        names = {r[0] for r in conn.execute("SELECT name FROM sqlite_master WHERE type='index'")}
+        tables = {r[0] for r in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+        conn.close()
+        assert {"idx_series_mod_study", "idx_series_study", "idx_image_series"} <= names
+        # The batch sorts on COALESCE(ZDATE/ZDATEADDED, '') over a handful of
+        # candidate PKs, which plain ZSTUDY column indexes cannot serve.
+        assert not any(n.startswith("idx_study_") for n in names)
+        # Planner statistics are gathered once the indexes exist.
+        assert "sqlite_stat1" in tables
+
+    def test_logs_warning_instead_of_raising(self, tmp_path, caplog):
+        db = tmp_path / "empty.sql"
+        _make_db(db)  # no Horos tables
+
+        with caplog.at_level(logging.WARNING, logger="horos_backup"):
+            ensure_snapshot_indexes(str(db))
+
+        assert "Could not create snapshot indexes" in caplog.text
+
+    def test_reuses_caller_connection_and_leaves_it_open(self, tmp_path):
+        db = tmp_path / "snap.sql"
+        conn = sqlite3.connect(str(db))
+        conn.execute("CREATE TABLE ZSERIES (Z_PK INTEGER PRIMARY KEY, ZSTUDY INTEGER, ZMODALITY TEXT)")
+        conn.execute("CREATE TABLE ZIMAGE (Z_PK INTEGER PRIMARY KEY, ZSERIES INTEGER)")
+        conn.execute(
+            "CREATE TABLE ZSTUDY (Z_PK INTEGER PRIMARY KEY, ZDATE REAL, ZDATEADDED REAL, ZSTUDYINSTANCEUID TEXT)"
+        )
+        conn.commit()
+        try:
+            ensure_snapshot_indexes(str(db), conn=conn)
+            # Still usable for the queries that follow.
+            names = {r[0] for r in conn.execute("SELECT name FROM sqlite_master WHERE type='index'")}
+        finally:
+            conn.close()
+        assert "idx_series_mod_study" in names
@@ -7,19 +7,23 @@
 # Thales Matheus Mendonça Santos - November 2025
 #
 import logging
+import os
 from pathlib import Path
 
 import pytest
 
 from horos_backup.config import BackupConfig, Paths, Settings
 from horos_backup.fs_utils import (
+    clear_listdir_cache,
     count_files_early,
     dump_fs_layout,
+    ensure_dirs,
     ensure_volume_mounted,
     latest_incomplete_month_folder,
     mark_month_done,
     reset_incomplete_latest_month,
     resolve_image_path,
+    resolve_image_path_str,
 )
 
 
@@ -32,6 +36,34 @@ def test_count_files_early(tmp_path):
     assert count_files_early(root, stop_after=3) == 4
 
 
+def test_count_files_early_walk_fallback(tmp_path, monkeypatch):
+    root = tmp_path / "root"
+    (root / "nested").mkdir(parents=True)
+    for i in range(3):
+        (root / "nested" / f"f{i}").write_text("x")
+
+    def no_find(*args, **kwargs):
+        raise FileNotFoundError("find")
+
+    # Without find(1) the Python walk must give the same answer.
+    monkeypatch.setattr("horos_backup.fs_utils.subprocess.Popen", no_find)
+    assert count_files_early(root, stop_after=10) == 3
+    assert count_files_early(root, stop_after=1) == 2
+
+
+def test_ensure_dirs_creates_nested_and_separate_roots(tmp_path):
+    config = BackupConfig(paths=Paths(pacs_root=tmp_path / "PACS"))
+    ensure_dirs(config)
+    for d in (config.paths.backup_root, config.paths.tmp_root, config.paths.dbcopy_dir):
+        assert d.is_dir()
+
+    # Directories outside backup_root are still created on their own.
+    config.paths.dbcopy_dir = tmp_path / "elsewhere" / "dbcopy"
+    ensure_dirs(config)
+    assert config.paths.dbcopy_dir.is_dir()
+    ensure_dirs(config)  # Idempotent.
+
+
 def test_ensure_volume_mounted(temp_config):
     # Should not raise when sentinel exists
     ensure_volume_mounted(temp_config)
@@ -45,7 +77,43 @@ def test_resolve_image_path_in_db(temp_config):
 
     resolved = resolve_image_path("file.dcm", 123, 1, temp_config)
     # In-database files should resolve into DATABASE.noindex subfolders.
-    assert resolved == target
+    assert resolved == (target, True)
+
+
+def test_resolve_image_path_listing_cache_is_cleared(temp_config):
+    db_sub = temp_config.paths.database_dir / "456"
+    db_sub.mkdir(parents=True, exist_ok=True)
+    (db_sub / "first.dcm").write_text("x")
+    assert resolve_image_path("first.dcm", 456, 1, temp_config) == (db_sub / "first.dcm", True)
+
+    # A file added after the listing was cached is still found via the stat fallback,
+    # and becomes visible to the fast path once the cache is cleared.
+    late = db_sub / "late.dcm"
+    late.write_text("x")
+    assert resolve_image_path("late.dcm", 456, 1, temp_config) == (late, True)
+    clear_listdir_cache()
+    assert resolve_image_path("late.dcm", 456, 1, temp_config) == (late, True)
+
+
+def test_resolve_image_path_listing_ignores_directories(temp_config):
+    db_sub = temp_config.paths.database_dir / "457"
+    (db_sub / "looks_like.dcm").mkdir(parents=True)
+    clear_listdir_cache()
+    # A directory with an image-like name is not a file, as with is_file().
+    assert resolve_image_path("looks_like.dcm", 457, 1, temp_config)[1] is False
+
+
+def test_resolve_image_path_str_returns_plain_string(temp_config):
+    db_sub = temp_config.paths.database_dir / "124"
+    db_sub.mkdir(parents=True, exist_ok=True)
+    target = db_sub / "file.dcm"
+    target.write_text("x")
+    clear_listdir_cache()
+
+    # The hot-loop variant resolves the same file without building a Path.
+    resolved, exists = resolve_image_path_str("file.dcm", 124, 1, temp_config)
+    assert type(resolved) is str
+    assert Path(resolved) == target and exists is True
 
 
 def test_resolve_image_path_relative_outside_db(temp_config):
@@ -55,7 +123,14 @@ def test_resolve_image_path_relative_outside_db(temp_config):
 
     resolved = resolve_image_path("relative/image.dcm", None, 0, temp_config)
     # Relative paths outside DB should resolve under Horos Data.
-    assert resolved == target
+    assert resolved == (target, True)
+
+
+def test_resolve_image_path_reports_miss(temp_config):
+    resolved, exists = resolve_image_path("missing.dcm", 789, 1, temp_config)
+    # A miss returns the primary candidate so callers can log where they looked.
+    assert resolved == temp_config.paths.database_dir / "789" / "missing.dcm"
+    assert exists is False
 
 
 # ---------------------------------------------------------------------------
@@ -136,6 +211,18 @@ class TestLatestIncompleteMonthFolder:
         result = latest_incomplete_month_folder(temp_config)
         assert result is None
 
+    def test_ignores_files_and_non_month_names(self, temp_config):
+        month_dir = temp_config.paths.backup_root / "2024_02"
+        month_dir.mkdir()
+        # Newer-looking names that are not month folders must not win.
+        (temp_config.paths.backup_root / "2024_09").write_text("not a dir")
+        (temp_config.paths.backup_root / "2024_99").mkdir()
+        (temp_config.paths.backup_root / "2025_01_old").mkdir()
+        # Non-ASCII digits do not match the [0-9] glob either.
+        (temp_config.paths.backup_root / "\uff12\uff10\uff12\uff15_01").mkdir()
+
+        assert latest_incomplete_month_folder(temp_config) == month_dir
+
 
 # ---------------------------------------------------------------------------
 # reset_incomplete_latest_month
@@ -232,6 +319,35 @@ class TestDumpFsLayout:
             dump_fs_layout(temp_config)
         assert "FS layout check" in caplog.text
 
+    def test_skips_scan_when_debug_disabled(self, temp_config, caplog, monkeypatch):
+        def no_scandir(*args, **kwargs):
+            raise AssertionError("scandir should not run")
+
+        monkeypatch.setattr("horos_backup.fs_utils.os.scandir", no_scandir)
+        with caplog.at_level(logging.INFO, logger="horos_backup"):
+            dump_fs_layout(temp_config)
+        assert "FS layout check" not in caplog.text
+        assert "dump_fs_layout failed" not in caplog.text
+
+    def test_production_logger_gates_the_scan_on_log_level(self, temp_config, monkeypatch):
+        from horos_backup.logging_setup import setup_logging, stop_logging
+
+        scans = []
+        real_scandir = os.scandir
+        monkeypatch.setattr("horos_backup.fs_utils.os.scandir", lambda p: scans.append(p) or real_scandir(p))
+        for level, expected_scans in (("INFO", 0), ("DEBUG", 1)):
+            name = f"horos_backup_test_layout_{level}"
+            temp_config.settings.log_level = level
+            # The logger run_once passes in: only log_level decides whether the scan runs.
+            log = setup_logging(temp_config, logger_name=name)
+            try:
+                dump_fs_layout(temp_config, logger=log)
+            finally:
+                stop_logging(name)
+                for h in list(log.handlers):
+                    log.removeHandler(h)
+            assert len(scans) == expected_scans
+
     def test_logs_failure_on_exception(self, tmp_path, caplog):
         # Construct a config whose horos_data_dir is a file, causing scandir to fail.
         paths = Paths(pacs_root=tmp_path / "PACS")
@@ -241,7 +357,7 @@ class TestDumpFsLayout:
         paths.database_dir.write_text("not a directory")
         config = BackupConfig(paths=paths)
 
-        with caplog.at_level(logging.ERROR, logger="horos_backup"):
+        with caplog.at_level(logging.DEBUG, logger="horos_backup"):
             dump_fs_layout(config)  # must not propagate the exception
 
         assert "dump_fs_layout failed" in caplog.text
\ No newline at end of file
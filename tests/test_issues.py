@@ -0,0 +1,134 @@
+#
+# test_issues.py
+# Horos Backup Script
+#
+# Checks that queued issue rows reach issues.csv with a single header, including rows logged from several threads.
+#
+# Thales Matheus Mendonça Santos - November 2025
+#
+import csv
+import errno
+import os
+import threading
+import time
+from datetime import datetime
+
+from horos_backup import issues
+from horos_backup.issues import ISSUES_HEADER, close_issues, flush_issues, issues_log
+
+
+def _rows(path):
+    with open(path, newline="", encoding="utf-8") as f:
+        return list(csv.reader(f))
+
+
+def test_issues_log_writes_header_once_after_flush(temp_config):
+    issues_log(temp_config, "NO_FILES", "1.2.3", "No valid files found", {"study_pk": 7})
+    issues_log(temp_config, "ZIP_FAIL", "1.2.4")
+    flush_issues()
+
+    rows = _rows(temp_config.paths.issues_csv)
+    assert rows[0] == ISSUES_HEADER
+    assert [r[1:4] for r in rows[1:]] == [["NO_FILES", "1.2.3", "No valid files found"], ["ZIP_FAIL", "1.2.4", ""]]
+    assert rows[1][4] == "{'study_pk': 7}"
+
+
+def test_issues_log_appends_to_existing_file_and_accepts_threads(temp_config):
+    issues_log(temp_config, "FIRST", "-")
+    # A new writer (as in the next run) must append without repeating the header.
+    close_issues()
+
+    threads = [
+        threading.Thread(target=issues_log, args=(temp_config, "THREADED", str(i))) for i in range(8)
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    flush_issues()
+
+    rows = _rows(temp_config.paths.issues_csv)
+    assert rows.count(ISSUES_HEADER) == 1
+    assert sorted(r[2] for r in rows if r[1] == "THREADED") == [str(i) for i in range(8)]
+
+
+def test_issues_log_burst_keeps_order(temp_config):
+    # More rows than one writerows() batch, with a flush barrier in between.
+    for i in range(300):
+        issues_log(temp_config, "BURST", str(i))
+    flush_issues()
+    for i in range(300, 600):
+        issues_log(temp_config, "BURST", str(i))
+    flush_issues()
+
+    rows = _rows(temp_config.paths.issues_csv)
+    assert [r[2] for r in rows[1:]] == [str(i) for i in range(600)]
+
+
+def test_issues_timestamp_matches_isoformat(temp_config):
+    before = datetime.now().replace(microsecond=0)
+    issues_log(temp_config, "STAMP", "-")
+    flush_issues()
+    after = datetime.now().replace(microsecond=0)
+
+    stamp = _rows(temp_config.paths.issues_csv)[-1][0]
+    # Cached per second but still the isoformat(timespec="seconds") text.
+    assert before <= datetime.fromisoformat(stamp) <= after
+    assert len(stamp) == len(before.isoformat(timespec="seconds"))
+
+
+def test_issues_writer_survives_unformattable_row(temp_config):
+    class Unprintable:
+        def __str__(self):
+            raise ValueError("boom")
+
+    issues_log(temp_config, "BEFORE", "-")
+    issues_log(temp_config, "BAD", "-", Unprintable())
+    issues_log(temp_config, "AFTER", "-")
+    # Only the bad row is dropped and the writer thread keeps running.
+    assert flush_issues(timeout=5) is True
+    issues_log(temp_config, "LATER", "-")
+    assert flush_issues(timeout=5) is True
+
+    kinds = [r[1] for r in _rows(temp_config.paths.issues_csv)[1:]]
+    assert kinds == ["BEFORE", "AFTER", "LATER"]
+
+
+def test_issues_writer_retries_rows_after_failed_write(temp_config, monkeypatch):
+    real_write = os.write
+    failed = []
+
+    def flaky_write(fd, data):
+        # The first write carrying a row fails as if the volume were full.
+        if not failed and b"LOST?" in bytes(data):
+            failed.append(fd)
+            raise OSError(errno.ENOSPC, "No space left on device")
+        return real_write(fd, data)
+
+    monkeypatch.setattr(os, "write", flaky_write)
+    issues_log(temp_config, "LOST?", "-")
+    assert flush_issues(timeout=5) is True
+    assert failed
+    issues_log(temp_config, "NEXT", "-")
+    assert flush_issues(timeout=5) is True
+    monkeypatch.undo()
+
+    # The row from the failed write is retried, once, ahead of later rows.
+    kinds = [r[1] for r in _rows(temp_config.paths.issues_csv)[1:]]
+    assert kinds == ["LOST?", "NEXT"]
+
+
+def test_close_issues_gives_up_on_a_stuck_writer(temp_config, monkeypatch):
+    issues_log(temp_config, "FIRST", "-")
+    assert flush_issues(timeout=5) is True
+    writer = issues._writer_for(temp_config.paths.issues_csv)
+    release = threading.Event()
+    # Every drain now hangs, as on an unresponsive external volume.
+    monkeypatch.setattr(writer, "_drain", release.wait)
+    issues_log(temp_config, "STUCK", "-")
+
+    started = time.monotonic()
+    assert flush_issues(timeout=0.2) is False
+    close_issues(timeout=0.2)
+    assert time.monotonic() - started < 3
+    release.set()
@@ -0,0 +1,24 @@
+#
+# test_locks.py
+# Horos Backup Script
+#
+# Checks that the run lock is exclusive and can be taken again once released.
+#
+# Thales Matheus Mendonça Santos - November 2025
+#
+from horos_backup.locks import acquire_lock, release_lock
+
+
+def test_second_acquire_is_refused_until_release(tmp_path):
+    lock_path = tmp_path / "tmp" / ".run.lock"
+    first = acquire_lock(lock_path)
+    assert first is not None
+    # Another open of the same file must not get the lock (overlapping run).
+    assert acquire_lock(lock_path) is None
+    # The holder's PID is recorded for troubleshooting.
+    assert lock_path.read_text().isdigit()
+
+    release_lock(first)
+    second = acquire_lock(lock_path)
+    assert second is not None
+    release_lock(second)
@@ -0,0 +1,140 @@
+#
+# test_logging_setup.py
+# Horos Backup Script
+#
+# Checks that queued, buffered logging still lands every record in the rotating log file.
+#
+# Thales Matheus Mendonça Santos - November 2025
+#
+import logging
+
+from horos_backup.logging_setup import setup_logging, stop_logging
+
+
+def test_setup_logging_writes_through_queue(temp_config):
+    name = "horos_backup_test_queue"
+    temp_config.settings.log_level = "DEBUG"
+    logger = setup_logging(temp_config, logger_name=name)
+    try:
+        # A second call must reuse the queue handler instead of stacking handlers.
+        assert setup_logging(temp_config, logger_name=name) is logger
+        assert len(logger.handlers) == 1
+        logger.info("first record")
+        logger.debug("second record")
+    finally:
+        stop_logging(name)
+        for h in list(logger.handlers):
+            logger.removeHandler(h)
+
+    text = temp_config.paths.log_file.read_text()
+    assert "[INFO] first record" in text
+    assert "[DEBUG] second record" in text
+
+
+def test_setup_logging_defaults_to_info(temp_config):
+    name = "horos_backup_test_level"
+    logger = setup_logging(temp_config, logger_name=name)
+    try:
+        # DEBUG-only diagnostics are gated on this and must be skipped by default.
+        assert not logger.isEnabledFor(logging.DEBUG)
+        logger.debug("hidden record")
+        logger.info("shown record")
+    finally:
+        stop_logging(name)
+        for h in list(logger.handlers):
+            logger.removeHandler(h)
+
+    text = temp_config.paths.log_file.read_text()
+    assert "shown record" in text and "hidden record" not in text
+
+
+def test_async_rotating_handler_gzips_backups(tmp_path):
+    import gzip
+
+    from horos_backup.logging_setup import AsyncRotatingFileHandler
+
+    log_file = tmp_path / "rot.log"
+    handler = AsyncRotatingFileHandler(str(log_file), maxBytes=200, backupCount=2)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    logger = logging.getLogger("horos_backup_test_rotation")
+    logger.propagate = False
+    logger.addHandler(handler)
+    try:
+        for i in range(30):
+            logger.warning("line %02d %s", i, "x" * 40)
+    finally:
+        logger.removeHandler(handler)
+        handler.close()
+
+    # Rolled files are compressed in the background and keep the .N.gz chain.
+    assert (tmp_path / "rot.log.1.gz").exists()
+    assert (tmp_path / "rot.log.2.gz").exists()
+    assert not (tmp_path / "rot.log.3.gz").exists()
+    assert not (tmp_path / "rot.log.1").exists()
+    assert b"line" in gzip.decompress((tmp_path / "rot.log.1.gz").read_bytes())
+
+
+def test_buffered_handler_flushes_warnings_immediately(tmp_path):
+    from horos_backup.logging_setup import BufferedRotatingFileHandler
+
+    log_file = tmp_path / "buf.log"
+    handler = BufferedRotatingFileHandler(str(log_file), maxBytes=1 << 20, backupCount=1)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    try:
+        handler.handle(logging.makeLogRecord({"msg": "routine", "levelno": logging.INFO}))
+        # INFO stays in the userspace buffer until a flush point.
+        assert log_file.read_text() == ""
+        handler.handle(logging.makeLogRecord({"msg": "trouble", "levelno": logging.WARNING}))
+        assert log_file.read_text() == "routine\ntrouble\n"
+    finally:
+        handler.close()
+
+
+def test_async_rotating_handler_folds_plain_backups_into_gz_chain(tmp_path):
+    import gzip
+
+    from horos_backup.logging_setup import AsyncRotatingFileHandler
+
+    log_file = tmp_path / "rot.log"
+    # Backups written before rolled files were compressed.
+    (tmp_path / "rot.log.1").write_text("legacy one\n")
+    (tmp_path / "rot.log.2").write_text("legacy two\n")
+    handler = AsyncRotatingFileHandler(str(log_file), maxBytes=200, backupCount=3)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    try:
+        # Three 67-byte records against maxBytes=200: exactly one rollover.
+        for i in range(3):
+            handler.handle(logging.makeLogRecord({"msg": "line %02d %s" % (i, "x" * 58), "levelno": logging.INFO}))
+    finally:
+        handler.close()
+
+    # The old files are compressed and shifted along, not overwritten.
+    assert not (tmp_path / "rot.log.1").exists()
+    assert not (tmp_path / "rot.log.2").exists()
+    assert not list(tmp_path.glob("*.tmp"))
+    assert gzip.decompress((tmp_path / "rot.log.1.gz").read_bytes()).startswith(b"line 00")
+    assert gzip.decompress((tmp_path / "rot.log.2.gz").read_bytes()) == b"legacy one\n"
+    assert gzip.decompress((tmp_path / "rot.log.3.gz").read_bytes()) == b"legacy two\n"
+
+
+def test_async_rotating_handler_keeps_and_reports_failed_compression(tmp_path, monkeypatch):
+    import horos_backup.logging_setup as ls
+
+    def broken_open(*args, **kwargs):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(ls.gzip, "open", broken_open)
+    log_file = tmp_path / "rot.log"
+    handler = ls.AsyncRotatingFileHandler(str(log_file), maxBytes=200, backupCount=2)
+    handler.setFormatter(logging.Formatter("%(levelname)s %(message)s"))
+    try:
+        for i in range(3):
+            handler.handle(logging.makeLogRecord({"msg": "line %02d %s" % (i, "x" * 150), "levelno": logging.INFO}))
+    finally:
+        handler.close()
+
+    # The rolled data survives uncompressed and the failure is in the log.
+    kept = list(tmp_path.glob("rot.log.1.gz.*.tmp"))
+    assert kept and all("line" in p.read_text() for p in kept)
+    assert not list(tmp_path.glob("*.gz"))
+    assert "ERROR Failed to gzip rotated log" in log_file.read_text()
@@ -15,6 +15,13 @@ def test_sanitize_name():
     assert sanitize_name("") == "UNKNOWN"
 
 
+def test_sanitize_name_ascii_and_unicode_paths_agree():
+    # The translate fast path (ASCII) must match the regex path (non-ASCII).
+    assert sanitize_name("  A^B  C//D\tE ") == "A_B__C_D_E"
+    assert sanitize_name("1.2.840.113619.2.55") == "1.2.840.113619.2.55"
+    assert sanitize_name("José^Ñuñez  x//y") == "Jos_u_ez__x_y"
+
+
 def test_build_zip_path_collision_and_truncation(tmp_path, temp_config):
     month_dir = tmp_path / "2023_02"
     month_dir.mkdir()
@@ -44,3 +51,38 @@ def test_build_zip_path_collision_and_truncation(tmp_path, temp_config):
     truncated = build_zip_path(month_dir, long_name, "2000-01-01", "2023-02-03", "UID123", temp_config)
     # Generated names must honor the configured max length.
     assert len(truncated.stem) <= temp_config.settings.max_name_noext
+
+
+def test_build_zip_path_skips_every_taken_suffix(tmp_path, temp_config):
+    month_dir = tmp_path / "2023_03"
+    month_dir.mkdir()
+    args = ("Patient", "1980-05-01", "2023-03-03", "UID9", temp_config)
+    first = build_zip_path(month_dir, *args)
+    first.touch()
+    for n in (2, 3, 5):
+        (month_dir / f"{first.stem}_{n}.zip").touch()
+
+    # The first gap in the suffixes is used.
+    assert build_zip_path(month_dir, *args).name == f"{first.stem}_4.zip"
+
+
+def test_build_zip_path_skips_reserved_names(tmp_path, temp_config):
+    month_dir = tmp_path / "2023_04"
+    month_dir.mkdir()
+    args = ("Patient", "1980-05-01", "2023-04-04", "UID7", temp_config)
+    first = build_zip_path(month_dir, *args)
+
+    # A name handed out earlier in the batch is taken even before it exists on disk.
+    reserved = {str(first)}
+    second = build_zip_path(month_dir, *args, reserved=reserved)
+    assert second.name == f"{first.stem}_2.zip"
+    reserved.add(str(second))
+    assert build_zip_path(month_dir, *args, reserved=reserved).name == f"{first.stem}_3.zip"
+
+
+def test_sanitize_name_is_memoized():
+    # Repeated patient names are answered from the cache with the same result.
+    sanitize_name.cache_clear()
+    assert sanitize_name("John Doe @#") == "John_Doe__"
+    assert sanitize_name("John Doe @#") == "John_Doe__"
+    assert sanitize_name.cache_info().hits == 1
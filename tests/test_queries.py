@@ -0,0 +1,39 @@
+#
+# test_queries.py
+# Horos Backup Script
+#
+# Runs the candidate statistics query against a tiny Horos-shaped schema with an attached state DB.
+#
+# Thales Matheus Mendonça Santos - November 2025
+#
+import sqlite3
+
+from horos_backup.queries import CREATE_CANDIDATES_INDEX, QUERY_CANDIDATE_STATS, build_candidates_table_sql
+
+
+def test_candidate_stats_single_pass(temp_config):
+    conn = sqlite3.connect(":memory:")
+    conn.row_factory = sqlite3.Row
+    conn.executescript(
+        """
+        CREATE TABLE ZSTUDY (Z_PK INTEGER PRIMARY KEY, ZSTUDYINSTANCEUID TEXT);
+        CREATE TABLE ZSERIES (Z_PK INTEGER PRIMARY KEY, ZSTUDY INTEGER, ZMODALITY TEXT);
+        INSERT INTO ZSTUDY VALUES (1, '1.1'), (2, '1.2'), (3, '1.3');
+        -- Study 1 has CT and MR series, study 2 only MR (lowercase, padded),
+        -- study 3 only US; study 4 has a CT series but no ZSTUDY row.
+        INSERT INTO ZSERIES VALUES (10, 1, 'CT'), (11, 1, 'MR'), (12, 1, 'CT'),
+                                   (20, 2, ' mr '), (30, 3, 'US'), (40, 4, 'CT');
+        """
+    )
+    conn.execute("ATTACH DATABASE ':memory:' AS state")
+    conn.execute("CREATE TABLE state.Exported (studyInstanceUID TEXT PRIMARY KEY)")
+    conn.execute("INSERT INTO state.Exported VALUES ('1.1'), ('9.9')")
+    conn.execute(build_candidates_table_sql(temp_config))
+    conn.execute(CREATE_CANDIDATES_INDEX)
+
+    row = conn.execute(QUERY_CANDIDATE_STATS).fetchone()
+
+    assert row["total_candidates"] == 3
+    assert row["series_ct"] == 2
+    assert row["series_mr"] == 2
+    assert row["exported_in_candidates"] == 1
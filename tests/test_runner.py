@@ -0,0 +1,171 @@
+#
+# test_runner.py
+# Horos Backup Script
+#
+# Runs full export cycles against a small synthetic Horos database and checks the ZIPs, state rows and issues they leave behind.
+#
+# Thales Matheus Mendonça Santos - November 2025
+#
+import csv
+import logging
+import sqlite3
+import zipfile
+
+import pytest
+
+from horos_backup.logging_setup import setup_logging, stop_logging
+from horos_backup.runner import run_once
+from horos_backup.zip_utils import verify_zip
+
+# Seconds since 2001-01-01 (Core Data reference date): mid-January 2020.
+_JAN_2020 = 600_000_000.0
+
+
+@pytest.fixture
+def horos_config(temp_config):
+    """
+    Build a Horos snapshot under ``tmp_path``: two CT/MR studies sharing one
+    UID (and so one ZIP base name), one more CT study, one study whose files
+    are missing and one US study outside the selected modalities.
+
+    Returns ``(config, expected_members)``.
+    """
+    settings = temp_config.settings
+    settings.sleep_between_studies = 0
+    settings.load_throttle_sleep = 0
+    paths = temp_config.paths
+
+    conn = sqlite3.connect(str(paths.horos_db_orig))
+    conn.executescript(
+        """
+        CREATE TABLE ZSTUDY (Z_PK INTEGER PRIMARY KEY, ZSTUDYINSTANCEUID TEXT, ZDATE REAL,
+                             ZDATEOFBIRTH REAL, ZNAME TEXT, ZDATEADDED REAL);
+        CREATE TABLE ZSERIES (Z_PK INTEGER PRIMARY KEY, ZSTUDY INTEGER, ZMODALITY TEXT);
+        CREATE TABLE ZIMAGE (Z_PK INTEGER PRIMARY KEY, ZSERIES INTEGER, ZPATHSTRING TEXT,
+                             ZPATHNUMBER INTEGER, ZSTOREDINDATABASEFOLDER INTEGER);
+        """
+    )
+    studies = [
+        (1, "1.2.3.1", "CT", 3),
+        (2, "1.2.3.2", "MR", 2),
+        (3, "1.2.3.2", "MR", 2),
+        (4, "1.2.3.4", "CT", 1),
+        (5, "1.2.3.5", "US", 1),
+    ]
+    expected = {}
+    img = 0
+    for pk, uid, modality, n_images in studies:
+        # Studies 2 and 3 share patient, dates and UID, hence the same ZIP name.
+        day = 0 if pk in (2, 3) else pk
+        conn.execute(
+            "INSERT INTO ZSTUDY VALUES (?, ?, ?, 0, ?, ?)",
+            (pk, uid, _JAN_2020 + day * 86400, "Doe^Jane" if pk in (2, 3) else f"Pat^{pk}", 1000.0 - pk),
+        )
+        conn.execute("INSERT INTO ZSERIES VALUES (?, ?, ?)", (pk, pk, modality))
+        names = set()
+        for _ in range(n_images):
+            img += 1
+            name = f"{img}.dcm"
+            folder = paths.database_dir / "10000"
+            folder.mkdir(parents=True, exist_ok=True)
+            (folder / name).write_bytes(b"image %d " % img * 100)
+            conn.execute("INSERT INTO ZIMAGE VALUES (?, ?, ?, 10000, 1)", (img, pk, name))
+            names.add(name)
+        expected[pk] = names
+    # A CT study whose only image is not on disk.
+    conn.execute("INSERT INTO ZSTUDY VALUES (9, '9.9.9', ?, 0, 'Ghost', 1)", (_JAN_2020,))
+    conn.execute("INSERT INTO ZSERIES VALUES (9, 9, 'CT')")
+    conn.execute("INSERT INTO ZIMAGE VALUES (999, 9, 'missing.dcm', 10000, 1)")
+    conn.commit()
+    conn.close()
+
+    # Members expected in each exported ZIP (studies 1-4).
+    return temp_config, [expected[pk] for pk in (1, 2, 3, 4)]
+
+
+def _run_with_production_logger(config, level):
+    # The logger run_once builds for launchd, at the given settings.log_level.
+    config.settings.log_level = level
+    name = f"horos_backup_test_runner_{level}"
+    log = setup_logging(config, logger_name=name)
+    try:
+        run_once(config, logger=log)
+    finally:
+        stop_logging(name)
+        for h in list(log.handlers):
+            log.removeHandler(h)
+    return config.paths.log_file.read_text()
+
+
+def _zips(config):
+    return sorted(config.paths.backup_root.rglob("*.zip"))
+
+
+def _exported_count(config):
+    conn = sqlite3.connect(str(config.paths.state_db))
+    try:
+        return conn.execute("SELECT COUNT(*) FROM Exported").fetchone()[0]
+    finally:
+        conn.close()
+
+
+def _issue_kinds(config):
+    with open(config.paths.issues_csv, newline="", encoding="utf-8") as f:
+        return [(r["kind"], r["study_uid"]) for r in csv.DictReader(f)]
+
+
+def test_run_once_exports_each_study_once(horos_config):
+    config, expected_members = horos_config
+    log = logging.getLogger("horos_backup")
+    run_once(config, logger=log)
+
+    # One valid ZIP per CT/MR study with files, including both studies that
+    # share a UID; the US study and the study without files get none.
+    zips = _zips(config)
+    assert len(zips) == 4
+    members = []
+    for z in zips:
+        assert verify_zip(z, deep=True)
+        with zipfile.ZipFile(z) as zf:
+            members.append(set(zf.namelist()))
+    assert sorted(map(sorted, members)) == sorted(map(sorted, expected_members))
+    assert len({z.name for z in zips}) == 4
+
+    # Exported is keyed by UID, so the shared UID is one row.
+    assert _exported_count(config) == 3
+    assert ("NO_FILES", "9.9.9") in _issue_kinds(config)
+    assert not list(config.paths.backup_root.rglob("*.part"))
+
+    # The next cycle finds nothing new to export.
+    run_once(config, logger=log)
+    assert _zips(config) == zips
+    assert _exported_count(config) == 3
+
+
+@pytest.mark.parametrize("level", ["INFO", "DEBUG"])
+def test_run_once_per_image_diagnostics_follow_log_level(horos_config, level):
+    config, _ = horos_config
+    text = _run_with_production_logger(config, level)
+
+    # The batch-level DEBUG check picks the bookkeeping-free image loop at INFO.
+    assert ("IMG CAND:" in text) is (level == "DEBUG")
+    assert ("ZIMAGE rows for study_pk=" in text) is (level == "DEBUG")
+    assert len(_zips(config)) == 4
+
+
+@pytest.mark.parametrize("level", ["INFO", "DEBUG"])
+def test_run_once_per_study_debug_records_follow_log_level(horos_config, monkeypatch, level):
+    import horos_backup.runner as runner
+
+    config, _ = horos_config
+    dumped = []
+    monkeypatch.setattr(runner, "debug_dump_date", lambda label, value, logger=None: dumped.append(label))
+    text = _run_with_production_logger(config, level)
+
+    # At INFO the per-study date dumps are never built, let alone queued.
+    if level == "DEBUG":
+        assert dumped.count("study_date") == dumped.count("dob") > 0
+        assert "Destination ZIP prepared for study" in text
+    else:
+        assert dumped == []
+        assert "Destination ZIP prepared for study" not in text
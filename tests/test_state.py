@@ -0,0 +1,90 @@
+#
+# test_state.py
+# Horos Backup Script
+#
+# Checks the state database helpers: WAL setup, batch-owned transactions for exports, and snapshot signatures.
+#
+# Thales Matheus Mendonça Santos - November 2025
+#
+import sqlite3
+
+from horos_backup.state import (
+    get_snapshot_signature,
+    mark_exported,
+    mark_exported_many,
+    set_snapshot_signature,
+    state_connect,
+)
+
+
+def test_state_connect_enables_wal(temp_config):
+    conn = state_connect(temp_config)
+    try:
+        assert conn.execute("PRAGMA journal_mode;").fetchone()[0] == "wal"
+        # synchronous=NORMAL is 1.
+        assert conn.execute("PRAGMA synchronous;").fetchone()[0] == 1
+    finally:
+        conn.close()
+
+
+def test_mark_exported_leaves_commit_to_the_batch(temp_config):
+    conn = state_connect(temp_config)
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        mark_exported(conn, "1.2.3", temp_config.paths.backup_root / "a.zip", commit=False)
+        mark_exported(conn, "1.2.4", temp_config.paths.backup_root / "b.zip", commit=False)
+        # Nothing is visible to other connections until the batch commits.
+        other = sqlite3.connect(str(temp_config.paths.state_db))
+        assert other.execute("SELECT COUNT(*) FROM Exported").fetchone()[0] == 0
+        conn.commit()
+        assert other.execute("SELECT COUNT(*) FROM Exported").fetchone()[0] == 2
+        other.close()
+    finally:
+        conn.close()
+
+
+def test_mark_exported_commits_by_default(temp_config):
+    conn = state_connect(temp_config)
+    try:
+        mark_exported(conn, "1.2.3", "a.zip")
+        # Standalone callers get a durable row without committing themselves.
+        other = sqlite3.connect(str(temp_config.paths.state_db))
+        assert other.execute("SELECT COUNT(*) FROM Exported").fetchone()[0] == 1
+        other.close()
+    finally:
+        conn.close()
+
+
+def test_rollback_discards_uncommitted_exports(temp_config):
+    conn = state_connect(temp_config)
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        mark_exported(conn, "1.2.3", "a.zip", commit=False)
+        conn.rollback()
+        assert conn.execute("SELECT COUNT(*) FROM Exported").fetchone()[0] == 0
+    finally:
+        conn.close()
+
+
+def test_mark_exported_many_upserts_batch(temp_config):
+    conn = state_connect(temp_config)
+    try:
+        mark_exported(conn, "1.2.3", "old.zip")
+        conn.execute("BEGIN IMMEDIATE")
+        mark_exported_many(conn, [("1.2.3", temp_config.paths.backup_root / "new.zip"), ("1.2.4", "b.zip")])
+        conn.commit()
+        rows = dict(conn.execute("SELECT studyInstanceUID, zip_path FROM Exported"))
+    finally:
+        conn.close()
+    assert rows == {"1.2.3": str(temp_config.paths.backup_root / "new.zip"), "1.2.4": "b.zip"}
+
+
+def test_snapshot_signature_round_trip(temp_config):
+    conn = state_connect(temp_config)
+    try:
+        assert get_snapshot_signature(conn) is None
+        set_snapshot_signature(conn, "db:1:2")
+        set_snapshot_signature(conn, "db:3:4")
+        assert get_snapshot_signature(conn) == "db:3:4"
+    finally:
+        conn.close()
@@ -7,12 +7,14 @@
 # Thales Matheus Mendonça Santos - November 2025
 #
 import logging
+import os
 import struct
+import threading
 import zipfile
 
 import pytest
 
-from horos_backup.zip_utils import verify_zip, zip_study_atomic
+from horos_backup.zip_utils import pick_compression, verify_zip, zip_study_atomic
 
 
 def test_zip_study_atomic_and_verify(tmp_path):
@@ -81,18 +83,88 @@ def test_verify_zip_logs_english_message_for_corrupt_entry(tmp_path, caplog):
     raw[central_offset + 16] ^= 0xFF
     out_zip.write_bytes(bytes(raw))
 
+    # A CRC mismatch is only visible to the full testzip() pass.
+    assert verify_zip(out_zip) is True
     with caplog.at_level(logging.ERROR, logger="horos_backup"):
-        result = verify_zip(out_zip)
+        result = verify_zip(out_zip, deep=True)
 
     assert result is False
     expected = f"testzip() found an error in {out_zip}: problematic entry: data.bin"
     assert any(record.getMessage() == expected for record in caplog.records)
 
 
+def test_verify_zip_deep_check_catches_corrupt_payload(tmp_path, caplog):
+    stored = tmp_path / "stored.bin"
+    stored.write_bytes(b"\x02" * 2048)
+    out_zip = tmp_path / "payload.zip"
+    zip_study_atomic([stored], out_zip)
+    assert verify_zip(out_zip, deep=True)
+
+    # Flip one payload byte; headers and central directory stay intact.
+    raw = bytearray(out_zip.read_bytes())
+    raw[raw.index(b"\x02" * 16) + 100] ^= 0xFF
+    out_zip.write_bytes(bytes(raw))
+
+    with caplog.at_level(logging.ERROR, logger="horos_backup"):
+        assert verify_zip(out_zip, deep=True) is False
+    assert "problematic entry: stored.bin" in caplog.text
+
+
+def test_verify_zip_quick_check_catches_bad_layout(tmp_path, caplog):
+    f = tmp_path / "data.bin"
+    f.write_bytes(b"\x01" * 1024)
+    out_zip = tmp_path / "bad_layout.zip"
+    zip_study_atomic([f], out_zip)
+
+    # Point the entry's local-header offset past the central directory.
+    raw = bytearray(out_zip.read_bytes())
+    central_offset = raw.index(b"PK\x01\x02")
+    struct.pack_into("<I", raw, central_offset + 42, central_offset + 4)
+    out_zip.write_bytes(bytes(raw))
+
+    # The quick layout check flags it and the testzip() fallback rejects it.
+    with caplog.at_level(logging.ERROR, logger="horos_backup"):
+        assert verify_zip(out_zip) is False
+    assert "problematic entry: data.bin" in caplog.text
+
+
+def test_verify_zip_quick_check_reads_local_extra_length(tmp_path, caplog):
+    first = tmp_path / "first.bin"
+    first.write_bytes(b"\x01" * 1024)
+    second = tmp_path / "second.bin"
+    second.write_bytes(b"\x02" * 1024)
+    out_zip = tmp_path / "bad_extra.zip"
+    zip_study_atomic([first, second], out_zip)
+
+    # A bogus extra-field length in the first local header shifts its data
+    # into the second member; the central directory still looks fine.
+    raw = bytearray(out_zip.read_bytes())
+    assert raw[:4] == b"PK\x03\x04"
+    struct.pack_into("<H", raw, 28, 200)
+    out_zip.write_bytes(bytes(raw))
+
+    with caplog.at_level(logging.ERROR, logger="horos_backup"):
+        assert verify_zip(out_zip) is False
+    assert "problematic entry: first.bin" in caplog.text
+
+
 # ---------------------------------------------------------------------------
 # zip_study_atomic – boundary / regression cases
 # ---------------------------------------------------------------------------
 
+def test_zip_study_atomic_accepts_string_paths(tmp_path):
+    f1 = tmp_path / "a.txt"
+    f1.write_text("hello")
+
+    out_zip = tmp_path / "out.zip"
+    # run_once passes plain strings; arcnames are still the bare file names.
+    zip_study_atomic([str(f1), str(tmp_path / "missing.txt")], out_zip)
+
+    with zipfile.ZipFile(out_zip) as zf:
+        assert zf.namelist() == ["a.txt"]
+    assert verify_zip(out_zip)
+
+
 def test_zip_study_atomic_with_empty_file_list(tmp_path):
     out_zip = tmp_path / "empty.zip"
     # An empty iterable should produce an empty but valid ZIP.
@@ -104,6 +176,25 @@ def test_zip_study_atomic_with_empty_file_list(tmp_path):
     assert verify_zip(out_zip)
 
 
+def test_zip_study_atomic_leaves_no_partial_file_on_failure(tmp_path):
+    out_dir = tmp_path / "2020_01"
+    (tmp_path / "ok.txt").write_text("x")
+
+    class Boom(Exception):
+        pass
+
+    def files():
+        # Fail after the first member has been written.
+        yield tmp_path / "ok.txt"
+        raise Boom()
+
+    with pytest.raises(Boom):
+        zip_study_atomic(files(), out_dir / "study.zip")
+
+    # The temp archive lives beside the target and is cleaned up on error.
+    assert list(out_dir.iterdir()) == []
+
+
 def test_zip_study_atomic_skips_nonexistent_files(tmp_path):
     real_file = tmp_path / "real.txt"
     real_file.write_text("content")
@@ -116,3 +207,245 @@ def test_zip_study_atomic_skips_nonexistent_files(tmp_path):
         assert "real.txt" in zf.namelist()
         assert "ghost.txt" not in zf.namelist()
     assert verify_zip(out_zip)
+
+
+def test_zip_study_atomic_stores_entries_by_default(tmp_path):
+    f = tmp_path / "image.dcm"
+    f.write_bytes(b"\x00" * 4096)
+    out_zip = tmp_path / "stored.zip"
+
+    zip_study_atomic([f], out_zip)
+
+    with zipfile.ZipFile(out_zip) as zf:
+        assert zf.getinfo("image.dcm").compress_type == zipfile.ZIP_STORED
+
+
+def test_zip_study_atomic_honors_deflate_override(tmp_path):
+    f = tmp_path / "image.dcm"
+    f.write_bytes(b"\x00" * 4096)
+    out_zip = tmp_path / "deflated.zip"
+
+    zip_study_atomic([f], out_zip, compression=zipfile.ZIP_DEFLATED, compresslevel=1)
+
+    with zipfile.ZipFile(out_zip) as zf:
+        info = zf.getinfo("image.dcm")
+        assert info.compress_type == zipfile.ZIP_DEFLATED
+        assert info.compress_size < info.file_size
+    assert verify_zip(out_zip)
+
+
+def test_zip_study_atomic_deflate_streams_multi_chunk_members(tmp_path):
+    f = tmp_path / "big.dcm"
+    payload = bytes(range(256)) * (3 * 4096 + 7)  # ~3 MiB, not chunk aligned
+    f.write_bytes(payload)
+    out_zip = tmp_path / "big.zip"
+
+    zip_study_atomic([f], out_zip, compression=zipfile.ZIP_DEFLATED, compresslevel=1)
+
+    with zipfile.ZipFile(out_zip) as zf:
+        assert zf.read("big.dcm") == payload
+        # The entry keeps the source file's timestamp, like ZipFile.write
+        # (DOS timestamps have 2-second resolution).
+        stored = zf.getinfo("big.dcm").date_time
+        source = zipfile.ZipInfo.from_file(str(f)).date_time
+        assert stored[:5] == source[:5] and stored[5] // 2 == source[5] // 2
+
+
+def test_zip_study_atomic_splits_large_deflate_members(tmp_path, monkeypatch):
+    import horos_backup.zip_utils as zu
+
+    # Tiny thresholds so a small file takes the block-parallel deflate path.
+    monkeypatch.setattr(zu, "PARALLEL_DEFLATE_MIN_SIZE", 1 << 16)
+    monkeypatch.setattr(zu, "PARALLEL_DEFLATE_BLOCK_SIZE", 1 << 14)
+    f = tmp_path / "multiframe.dcm"
+    payload = b"".join(b"frame %06d " % i + bytes(range(i % 251)) for i in range(2000))
+    f.write_bytes(payload)
+    serial = tmp_path / "serial.dcm"
+    serial.write_bytes(b"small")
+    out_zip = tmp_path / "multiframe.zip"
+
+    zip_study_atomic([f, serial], out_zip, compression=zipfile.ZIP_DEFLATED, compresslevel=1)
+
+    with zipfile.ZipFile(out_zip) as zf:
+        assert zf.read("multiframe.dcm") == payload
+        assert zf.read("serial.dcm") == b"small"
+        # Priming each block with the previous window keeps it compressing.
+        assert zf.getinfo("multiframe.dcm").compress_size < len(payload) // 2
+    assert verify_zip(out_zip, deep=True)
+
+
+def test_parallel_deflate_shares_one_pool(tmp_path, monkeypatch):
+    import horos_backup.zip_utils as zu
+
+    monkeypatch.setattr(zu, "PARALLEL_DEFLATE_MIN_SIZE", 1 << 16)
+    monkeypatch.setattr(zu, "PARALLEL_DEFLATE_BLOCK_SIZE", 1 << 14)
+    files = []
+    for i in range(4):
+        f = tmp_path / f"large{i}.dcm"
+        f.write_bytes(b"".join(b"frame %d-%06d " % (i, n) for n in range(8000)))
+        files.append(f)
+
+    # Two archives, several large members each: all blocks go to one pool
+    # no larger than the CPU count instead of a new pool per member.
+    zip_study_atomic(files[:2], tmp_path / "a.zip", compression=zipfile.ZIP_DEFLATED, compresslevel=1)
+    pool = zu._deflate_pool()
+    zip_study_atomic(files[2:], tmp_path / "b.zip", compression=zipfile.ZIP_DEFLATED, compresslevel=1)
+    assert zu._deflate_pool() is pool
+
+    deflaters = [t for t in threading.enumerate() if t.name.startswith("zip-deflate")]
+    assert 0 < len(deflaters) <= (os.cpu_count() or 1)
+    for name, members in (("a.zip", files[:2]), ("b.zip", files[2:])):
+        with zipfile.ZipFile(tmp_path / name) as zf:
+            for f in members:
+                assert zf.read(f.name) == f.read_bytes()
+
+
+@pytest.mark.parametrize("compression", [zipfile.ZIP_DEFLATED, zipfile.ZIP_BZIP2])
+def test_zip_study_atomic_compressed_members_round_trip(tmp_path, compression):
+    files = []
+    for i in range(6):
+        f = tmp_path / f"frame{i}.dcm"
+        f.write_bytes((b"%d" % i) * (5000 + i))
+        files.append(f)
+    out_zip = tmp_path / "compressed.zip"
+
+    # Deflate runs on the reader threads; other methods use the serial writer.
+    zip_study_atomic(files, out_zip, compression=compression, compresslevel=1, workers=3)
+
+    with zipfile.ZipFile(out_zip) as zf:
+        assert zf.namelist() == [f.name for f in files]
+        for f in files:
+            assert zf.getinfo(f.name).compress_type == compression
+            assert zf.read(f.name) == f.read_bytes()
+    assert verify_zip(out_zip, deep=True)
+
+
+@pytest.mark.skipif(not hasattr(os, "posix_fadvise"), reason="posix_fadvise is Linux-only")
+def test_zip_study_atomic_drops_source_pages_after_reading(tmp_path, monkeypatch):
+    import horos_backup.zip_utils as zu
+
+    advised = []
+    monkeypatch.setattr(zu, "_posix_fadvise", lambda fd, off, length, advice: advised.append((fd, advice)))
+    opened = []
+    real_open = os.open
+    monkeypatch.setattr(zu.os, "open", lambda *a, **kw: opened.append(a[0]) or real_open(*a, **kw))
+    stored = tmp_path / "stored.dcm"
+    stored.write_bytes(b"s" * 4096)
+    deflated = tmp_path / "deflated.dcm"
+    deflated.write_bytes(b"d" * 4096)
+
+    zip_study_atomic([stored], tmp_path / "s.zip")
+    zip_study_atomic([deflated], tmp_path / "d.zip", compression=zipfile.ZIP_DEFLATED, compresslevel=1)
+
+    # Every read-once source is advised once, on the descriptor it was read
+    # through: no file is opened a second time just for the hint.
+    assert [a for _, a in advised] == [os.POSIX_FADV_DONTNEED] * 2
+    assert [str(p) for p in opened if str(p).endswith(".dcm")] == [str(stored), str(deflated)]
+
+
+def test_zip_study_atomic_without_fadvise(tmp_path, monkeypatch):
+    import horos_backup.zip_utils as zu
+
+    monkeypatch.setattr(zu, "_posix_fadvise", None)
+    src = tmp_path / "a.dcm"
+    src.write_bytes(b"a" * 4096)
+    out_zip = tmp_path / "a.zip"
+    zip_study_atomic([src], out_zip)
+    assert verify_zip(out_zip, deep=True)
+
+
+def test_zip_study_atomic_parallel_readers_keep_input_order(tmp_path):
+    files = []
+    for i in range(20):
+        f = tmp_path / f"img{i:02d}.dcm"
+        f.write_bytes(bytes([i]) * (1000 * (i + 1)))
+        files.append(f)
+    out_zip = tmp_path / "ordered.zip"
+
+    zip_study_atomic(files, out_zip, workers=4)
+
+    with zipfile.ZipFile(out_zip) as zf:
+        assert zf.namelist() == [f.name for f in files]
+        assert zf.read("img07.dcm") == bytes([7]) * 8000
+    assert verify_zip(out_zip)
+
+
+@pytest.mark.parametrize("kernel_copy", [True, False])
+def test_zip_study_atomic_large_stored_members(tmp_path, monkeypatch, kernel_copy):
+    import horos_backup.zip_utils as zu
+
+    monkeypatch.setattr(zu, "_kernel_copy_available", kernel_copy and zu._kernel_copy_available)
+    # Small slices so the user-space fallback writes the member in pieces,
+    # and small kernel requests so the copy loop runs several rounds.
+    monkeypatch.setattr(zu, "FALLBACK_WRITE_SIZE", 1 << 16)
+    monkeypatch.setattr(zu, "KERNEL_COPY_CHUNK", 1 << 18)
+    big = tmp_path / "big.dcm"
+    big.write_bytes(bytes(range(256)) * (zu.KERNEL_COPY_MIN_SIZE // 256 + 17))
+    small = tmp_path / "small.dcm"
+    small.write_bytes(b"tail")
+    out_zip = tmp_path / "large.zip"
+
+    # Large members may bypass userspace; layout must be identical either way.
+    zip_study_atomic([big, small, big.with_name("big2.dcm")], out_zip)
+
+    with zipfile.ZipFile(out_zip) as zf:
+        assert zf.namelist() == ["big.dcm", "small.dcm"]
+        assert zf.read("big.dcm") == big.read_bytes()
+        assert zf.read("small.dcm") == b"tail"
+    assert verify_zip(out_zip)
+
+
+def _dicom_with_transfer_syntax(path, ts_uid):
+    # Minimal Part 10 header: preamble, magic and a File Meta group.
+    value = ts_uid.encode("ascii")
+    if len(value) % 2:
+        value += b"\x00"
+    meta = struct.pack("<HH2sH", 0x0002, 0x0001, b"OB", 0) + struct.pack("<I", 2) + b"\x00\x01"
+    meta += struct.pack("<HH2sH", 0x0002, 0x0010, b"UI", len(value)) + value
+    path.write_bytes(b"\x00" * 128 + b"DICM" + meta + struct.pack("<HH", 0x0008, 0x0016))
+    return path
+
+
+@pytest.mark.parametrize(
+    "ts_uid, expected",
+    [
+        ("1.2.840.10008.1.2.4.70", (zipfile.ZIP_STORED, None)),  # JPEG lossless
+        ("1.2.840.10008.1.2.4.90", (zipfile.ZIP_STORED, None)),  # JPEG 2000
+        ("1.2.840.10008.1.2.5", (zipfile.ZIP_STORED, None)),  # RLE
+        ("1.2.840.10008.1.2.1", (zipfile.ZIP_DEFLATED, 1)),  # explicit VR little endian
+        ("1.2.840.10008.1.2", (zipfile.ZIP_DEFLATED, 1)),  # implicit VR little endian
+    ],
+)
+def test_pick_compression_follows_transfer_syntax(tmp_path, ts_uid, expected):
+    f = _dicom_with_transfer_syntax(tmp_path / "img.dcm", ts_uid)
+    assert pick_compression([f]) == expected
+
+
+def test_zip_study_atomic_stores_precompressed_members_of_deflated_study(tmp_path):
+    native = _dicom_with_transfer_syntax(tmp_path / "native.dcm", "1.2.840.10008.1.2.1")
+    jpeg = _dicom_with_transfer_syntax(tmp_path / "jpeg.dcm", "1.2.840.10008.1.2.4.50")
+    out_zip = tmp_path / "mixed.zip"
+
+    zip_study_atomic([native, jpeg], out_zip, compression=zipfile.ZIP_DEFLATED, compresslevel=1)
+
+    with zipfile.ZipFile(out_zip) as zf:
+        # The per-file transfer syntax overrides the study-level deflate.
+        assert zf.getinfo("native.dcm").compress_type == zipfile.ZIP_DEFLATED
+        assert zf.getinfo("jpeg.dcm").compress_type == zipfile.ZIP_STORED
+        assert zf.read("jpeg.dcm") == jpeg.read_bytes()
+    assert verify_zip(out_zip, deep=True)
+
+
+def test_pick_compression_uses_configured_deflate_level(tmp_path):
+    native = _dicom_with_transfer_syntax(tmp_path / "native.dcm", "1.2.840.10008.1.2.1")
+    jpeg = _dicom_with_transfer_syntax(tmp_path / "jpeg.dcm", "1.2.840.10008.1.2.4.50")
+    assert pick_compression([native], deflate_level=6) == (zipfile.ZIP_DEFLATED, 6)
+    # Stored studies ignore the level.
+    assert pick_compression([jpeg], deflate_level=6) == (zipfile.ZIP_STORED, None)
+
+
+def test_pick_compression_keeps_stored_for_non_dicom(tmp_path):
+    f = tmp_path / "notes.txt"
+    f.write_text("not a dicom file")
+    assert pick_compression([f]) == (zipfile.ZIP_STORED, None)
+    assert pick_compression([]) == (zipfile.ZIP_STORED, None)